@@ -1,13 +1,19 @@
 import sys
 import numpy as np
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QComboBox, QTextEdit, QLabel, QHBoxLayout, QLineEdit
-from PyQt5.QtCore import QTimer, QThread, pyqtSignal, Qt
+from PyQt5.QtCore import QTimer, QThread, Qt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas, NavigationToolbar2QT
 import matplotlib.pyplot as plt
 import time
 
 import numpy as np
 from station_2pac import get_station
+from acquisition import make_station_acquisition, LatestValues
+from live_plot import IncrementalLivePlot
+from live_store import LiveStore
+from state_graph import module_state_graph
+from log_writer import BufferedDataSaver, DeadbandFilter, STATION_DEADBANDS
+from quench_trigger import start_quench_capture
 from qcodes import (initialise_or_create_database_at,
 load_or_create_experiment,
 Measurement)
@@ -42,44 +48,37 @@ meas.register_parameter(st.cryocon.chB_temperature, setpoints=[elapsed_time])
 meas.register_parameter(st.cryocon.chC_temperature, setpoints=[elapsed_time])
 meas.register_parameter(st.cryocon.chD_temperature, setpoints=[elapsed_time])
 meas.register_parameter(st.labjack.kepco_current, setpoints=[elapsed_time])
-meas.register_parameter(st.labjack.kepco_voltage)
+meas.register_parameter(st.labjack.kepco_voltage, setpoints=[elapsed_time])
 meas.register_parameter(st.ls370.heater.out, setpoints=[elapsed_time])
-meas.register_parameter(st.labjack.relay, paramtype="text")
-meas.register_parameter(st.labjack.heatswitch_adr, paramtype="text")
-meas.register_parameter(st.labjack.heatswitch_charcoal, paramtype="text")
-meas.register_parameter(st.labjack.heatswitch_pot, paramtype="text")
+meas.register_parameter(st.labjack.relay, paramtype="text", setpoints=[elapsed_time])
+meas.register_parameter(st.labjack.heatswitch_adr, paramtype="text", setpoints=[elapsed_time])
+meas.register_parameter(st.labjack.heatswitch_charcoal, paramtype="text", setpoints=[elapsed_time])
+meas.register_parameter(st.labjack.heatswitch_pot, paramtype="text", setpoints=[elapsed_time])
 meas.register_parameter(st.labjack.he3_pressure, setpoints=[elapsed_time])
 meas.register_custom_parameter("state", paramtype="text")
 meas.register_custom_parameter("faa_temperature", unit="K", setpoints=[elapsed_time])
 meas.register_custom_parameter("time", unit="s")
 
-def retry(f,n=3):
-    # try cryocon is being unreliable on returning temp, so try a few times then return nan
-    for i in range(n):
-        try:
-            return f()
-        except: 
-            pass
-            # print(f"RETRYING {i=}")
-            # st.cryocon.write("CLR")
-            # time.sleep(0.1)
-    return np.nan
+# each instrument is read on its own worker thread, see acquisition.py
+acquisition = make_station_acquisition(st)
+# newest value of every logged parameter, written each tick by update
+latest = LatestValues()
 
 def update(datasaver, state):
     # st.cryocon.write("CLR") # try to help the cryocon work more reliably
-    parameters = [elapsed_time, st.cryocon.chA_temperature, st.cryocon.chB_temperature,
-                  st.cryocon.chC_temperature, st.cryocon.chD_temperature, st.labjack.kepco_current, st.labjack.kepco_voltage, st.ls370.heater.out,
-                  st.labjack.relay, st.labjack.heatswitch_adr, st.labjack.heatswitch_charcoal, st.labjack.heatswitch_pot, st.labjack.he3_pressure]
-    l=[(param,retry(param,n=1)) for param in parameters]+[("state", state.name()),("faa_temperature", st.ls370.ch04.temperature()), ("time", time.time())]
+    return record(datasaver, state, acquisition.acquire(state.name()))
+
+def record(datasaver, state, results):
+    # results as returned by acquisition.acquire or acquire_async
+    l=[(elapsed_time, elapsed_time())]+results
+    now = time.time()
+    l+=[("state", state.name()), ("time", now)]
     datasaver.add_result(*l)
+    latest.record(l, timestamp=now)
+    return l
 
 def most_recent_measurements():
-    data = datasaver_global.dataset.cache.data()
-    ret = {}
-    for key in data.keys():
-        v = data[key][key][-1]
-        ret[key]=v
-    return ret
+    return latest.snapshot()
 
 def pretty_str_dict(d: dict):
     s = ""
@@ -95,9 +94,21 @@ import typing
 class StationWorld(World):
     station: qcodes.station.Station = None
     datasaver: typing.Any = None
+    live_store: LiveStore = None
 
     def update(self, state):
-        update(self.datasaver, state)
+        row = update(self.datasaver, state)
+        if self.live_store is not None:
+            self.live_store.record(row)
+
+    def record(self, state, results):
+        row = record(self.datasaver, state, results)
+        if self.live_store is not None:
+            self.live_store.record(row)
+
+    def on_state_change(self, old_state, new_state):
+        # get everything up to the transition onto disk
+        self.datasaver.flush()
 
 @state 
 def full_cycle_one_state(world: StationWorld):
@@ -299,12 +310,16 @@ def warmup_300K(world: StationWorld):
 
 # Worker thread that calls get_data in the background
 class DataFetchThread(QThread):
-    state_update = pyqtSignal(str, str)
+    # the gui polls latest_line on its own timer instead of getting a signal per line, so
+    # lines run faster than the frame rate are coalesced, only the newest one is ever shown
     def __init__(self, world, first_state, states_dict):
         super().__init__()
         self.world = world
         self.next_state = first_state
         self.states_dict = states_dict
+        # every state the runner has been in, by name, so the gui can look up the source for a name
+        self.states_seen = dict(states_dict)
+        self.latest_line = None  # (state name, line number)
         self.state = None
         self.current_combo_value = "a"  # Default value
 
@@ -314,22 +329,23 @@ class DataFetchThread(QThread):
         self.next_state = self.states_dict[value]
     
     def run(self):
-        runner = self.world.state_runner(self.next_state)
-        self.state = self.next_state
-        self.next_state = None
-        state = self.state
-        time.sleep(max(0, self.world.next_tick_target_time_s()-time.time()))
-        self.world._update(state)
-        tstart = self.world.last_update_time_s
-        for (state, line_number) in runner:
-            self.state = state
-            if self.next_state is not None:
-                print("switching state")
-                self.run()
-            elapsed = self.world.last_update_time_s-tstart
-            s1 = f"state={state.name()} {line_number=} {elapsed=:.2f} state_elapsed_s={self.world.state_elapsed_s():.2f}"
-            s2 = state.code_highlighted(line_number)
-            self.state_update.emit(s1, s2)
+        while self.next_state is not None:
+            runner = self.world.state_runner(self.next_state)
+            self.state = self.next_state
+            self.next_state = None
+            state = self.state
+            time.sleep(max(0, self.world.next_tick_target_time_s()-time.time()))
+            self.world._update(state)
+            for (state, line_number) in runner:
+                self.state = state
+                if self.next_state is not None:
+                    print("switching state")
+                    self.world.on_state_change(state, self.next_state)
+                    # closing runs the runner's finally, which stops its acquisition thread before the next one starts
+                    runner.close()
+                    break
+                self.states_seen[state.name()] = state
+                self.latest_line = (state.name(), line_number)
 
 def adjust_lightness(color, amount=0.5):
     import matplotlib.colors as mc
@@ -353,12 +369,15 @@ def plot_dataset(dataset, ax, xloc_mouse):
     # print(data)
     t = dataset.cache.data()["time"]["time"]
     x = t-t[0] 
+    # parameters read less often than every tick or thinned by the deadband have fewer rows, plot each
+    # against its own elapsed_time, held until its next sample
+    xs = {key: data[key]["elapsed_time"] if "elapsed_time" in data[key] else x for key in data.keys()}
     if xloc_mouse is None:
         xloc_ind = None
         data_xloc = None
     else:
         xloc_ind = np.argmin(np.abs(x-xloc_mouse))
-        data_xloc = {key:data[key][key][xloc_ind] for key in data.keys()}
+        data_xloc = {key:data[key][key][np.argmin(np.abs(xs[key]-xloc_mouse))] for key in data.keys()}
     data_mr = {key:data[key][key][-1] for key in data.keys()}
     # print(f"{list(data.keys())=}")
     keys_hs = ["labjack_heatswitch_adr", "labjack_heatswitch_charcoal", "labjack_heatswitch_pot", "labjack_relay"]
@@ -370,7 +389,7 @@ def plot_dataset(dataset, ax, xloc_mouse):
         unit = units[key]
         try:
             val = data_mr[key]
-            ax.plot(x, v, label=f"{key}={val:.2f} {unit}")
+            ax.plot(xs[key], v, drawstyle="steps-post", label=f"{key}={val:.2f} {unit}")
         except:
             print(f"failed to plot {key}")
 
@@ -380,14 +399,15 @@ def plot_dataset(dataset, ax, xloc_mouse):
     base_colors = [cmap(i) for i in range(len(keys_hs))]  # RGBA tuples
 
     for i, key in enumerate(keys_hs):
+        v = np.asarray(data[key][key])
         if key == "labjack_relay":
-            v_open = np.array([d=="CONTROL" for d in data[key][key]])
-            v_closed = np.array([d=="RAMP" for d in data[key][key]])
-            v_unknown = np.array([d=="UNKNOWN" for d in data[key][key]])
+            v_open = v=="CONTROL"
+            v_closed = v=="RAMP"
+            v_unknown = v=="UNKNOWN"
         else:
-            v_open = np.array([d=="OPEN" for d in data[key][key]])
-            v_closed = np.array([d=="CLOSED" for d in data[key][key]])
-            v_unknown = np.array([d=="UNKNOWN" for d in data[key][key]])            
+            v_open = v=="OPEN"
+            v_closed = v=="CLOSED"
+            v_unknown = v=="UNKNOWN"
         yval = (2e-2)*(0.9**i)
         y_open = np.where(v_open, yval, np.nan)
         y_closed = np.where(v_closed, yval, np.nan)
@@ -399,9 +419,9 @@ def plot_dataset(dataset, ax, xloc_mouse):
 
         val = data_mr[key]
 
-        ax.plot(x, y_closed, color=color, lw=4, label=f"{key}={val}")
-        ax.plot(x, y_open, color=color, lw=2)
-        ax.plot(x, y_unknown, "--", color=color, lw=2)
+        ax.plot(xs[key], y_closed, color=color, lw=4, drawstyle="steps-post", label=f"{key}={val}")
+        ax.plot(xs[key], y_open, color=color, lw=2, drawstyle="steps-post")
+        ax.plot(xs[key], y_unknown, "--", color=color, lw=2, drawstyle="steps-post")
 
 
 
@@ -439,70 +459,29 @@ def plot_dataset(dataset, ax, xloc_mouse):
     # ax.set_ylim(ylim)
     # ax.set_xlim(xlim)
 
-def get_arrow_linenum(s2):
-    # Split the string into lines
-    lines = s2.split('\n')
-
-    # Find the index of the line starting with '-->'
-    for i, line in enumerate(lines):
-        if line.startswith('-->'):
-            # print(f"Index of the line starting with '-->': {i}")
-            break
-    return i
-
-def get_arrow_char_index(s2, plus=0):
-    lines = s2.split('\n')
-    char_index = 0
-
-    for line in lines:
-        if line.startswith('-->'):
-            return min(char_index+plus, len(s2)-1)
-        # Add length of line + 1 for the newline character
-        char_index += len(line) + 1
-
-    return 0  # Not found
-
-def color_line(textedit, line_number, color=None):
-    from PyQt5.QtGui import QTextCursor, QTextCharFormat, QColor
+def highlight_state_line(textedit, state, line_number, color=None):
+    # move the highlight to a line of the source already in textedit, the document itself isn't touched
+    from PyQt5.QtGui import QTextCursor, QColor, QTextFormat
 
     if color is None:
-        color = QColor("yellow")  # Default color if none is provided
-
-    # Access the document and validate line number
-    doc = textedit.document()
-    if line_number < 0 or line_number >= doc.blockCount():
+        color = QColor("yellow")
+    if line_number < 0 or line_number >= len(state.line_offsets):
         return  # Out of range
 
-    # Clear all previous highlights by resetting formatting for all blocks
-    cursor = QTextCursor(doc)
-    cursor.beginEditBlock()  # Group all changes for efficiency
-
-    block = doc.firstBlock()
-    while block.isValid():
-        block_cursor = QTextCursor(block)
-        block_cursor.select(QTextCursor.LineUnderCursor)
-        block_cursor.setCharFormat(QTextCharFormat())  # Reset to default
-        block = block.next()
-
-    cursor.endEditBlock()
-
-    # Now, highlight the specified line
-    block = doc.findBlockByNumber(line_number)
-    cursor = QTextCursor(block)
-
-    # Set the background color for the specified line
-    fmt = QTextCharFormat()
-    fmt.setBackground(color)
-
-    # Select the entire line and apply the format
-    cursor.select(QTextCursor.LineUnderCursor)
-    cursor.setCharFormat(fmt)
+    selection = QTextEdit.ExtraSelection()
+    selection.format.setBackground(color)
+    selection.format.setProperty(QTextFormat.FullWidthSelection, True)
+    selection.cursor = QTextCursor(textedit.document())
+    selection.cursor.setPosition(state.line_offsets[line_number])
+    textedit.setExtraSelections([selection])
+    textedit.setTextCursor(selection.cursor)
+    textedit.ensureCursorVisible()
 
 
 
 
 class MyApp(QWidget):
-    def __init__(self, world, dataset, states_dict):
+    def __init__(self, world, dataset, states_dict, incremental_plot=True, state_graph=None, fps=10):
         super().__init__()
 
         screen_geometry = QApplication.desktop().screenGeometry()
@@ -528,6 +507,11 @@ class MyApp(QWidget):
         self.canvas = FigureCanvas(self.figure)
         self.toolbar = NavigationToolbar2QT(self.canvas, self)
         self.figure.canvas.mpl_connect("motion_notify_event", self.mpl_on_mouse_move)
+        # incremental_plot keeps the lines between ticks, reads the world's bounded live_store and blits,
+        # otherwise every tick clears the axes and replots the whole run with plot_dataset
+        self.live_plot = None
+        if incremental_plot and world.live_store is not None:
+            self.live_plot = IncrementalLivePlot(self.ax, self.canvas)
 
         # Set up the plot layout
         plot_layout = QVBoxLayout()
@@ -540,6 +524,11 @@ class MyApp(QWidget):
         # Create dropdown (ComboBox)
         self.combo_box = QComboBox(self)
         self.combo_box.addItems(list(states_dict.keys()))
+        if state_graph is not None:
+            # where each state can go next, from the graph worked out once at startup
+            for i, name in enumerate(states_dict.keys()):
+                targets = ["stop" if target is None else target for target in state_graph.edges.get(name, [])]
+                self.combo_box.setItemData(i, f"exits to: {', '.join(targets) or 'nothing'}", Qt.ToolTipRole)
         self.combo_box.currentTextChanged.connect(self.update_title)
         right_layout.addWidget(self.combo_box)
 
@@ -581,67 +570,103 @@ class MyApp(QWidget):
         self.data_thread = DataFetchThread(world, 
                                            first_state=wait_forever, 
                                            states_dict=states_dict)
-        self.data_thread.state_update.connect(self.state_update)
+        self.shown_state_name = None
+        self.shown_line = None
         self.combo_box.currentTextChanged.connect(self.data_thread.set_combo_value)
         self.data_thread.start()
 
         self.on_mouse_move_event = None
+        self.mouse_moved = False
+        self.plotted_update_time_s = None
         self.update_plot()
 
+        # at most one refresh per frame, whatever the state thread is doing in between
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start(int(1000/fps))
+
+    def refresh(self):
+        latest_line = self.data_thread.latest_line
+        if latest_line is not None and latest_line != self.shown_line:
+            self.state_update(*latest_line)
+            self.shown_line = latest_line
+        # the plot only changes when the world has logged a new row, or the mouse moved
+        if self.world.last_update_time_s != self.plotted_update_time_s or self.mouse_moved:
+            self.mouse_moved = False
+            self.update_plot()
+
     def update_title(self):
         selected = self.combo_box.currentText()
         self.setWindowTitle(f"Selected: {selected} curent_wait={self.world.to_wait_for_process_line:.6g} s")
 
-    def state_update(self, s1, s2):
-        # print(s1)
+    def state_update(self, state_name, line_number):
         self.update_title()
-        self.text_output.setText(s2)
-        textCursor = self.text_output.textCursor()
-        textCursor.setPosition(get_arrow_char_index(s2,plus=100))
-        color_line(self.text_output, get_arrow_linenum(s2))
-        self.text_output.setTextCursor(textCursor)
+        state = self.data_thread.states_seen[state_name]
+        # the source is only set when the state changes, each line just moves the highlight
+        if state_name != self.shown_state_name:
+            self.text_output.setPlainText(state.raw_source)
+            self.shown_state_name = state_name
+        highlight_state_line(self.text_output, state, line_number)
         keys_hs = ["labjack_heatswitch_adr", "labjack_heatswitch_charcoal", "labjack_heatswitch_pot", "labjack_relay"]
         # mr = most_recent_measurements()
         # for i, key in enumerate(keys_hs):
         #     value = mr[key]
         #     self.labels[i].setText(f"{key} {value}")
-        self.update_plot()
 
     def update_plot(self):
         dataset = self.dataset
+        self.plotted_update_time_s = self.world.last_update_time_s
         if self.on_mouse_move_event is None:
             xloc_for_vals = None
         else:
             xloc_for_vals = self.on_mouse_move_event.xdata
+        if self.live_plot is not None:
+            self.live_plot.update(self.world.live_store, xloc_for_vals)
+            return
         plot_dataset(dataset, self.ax, xloc_for_vals)
         self.figure.tight_layout()
         self.canvas.draw()
 
     def mpl_on_mouse_move(self, event):
         self.on_mouse_move_event=event
+        self.mouse_moved = True
 
 
 
 def main():
-    with meas.run() as datasaver:
-        world = StationWorld(station=st)
+    # the gui reads the bounded live_store, so qcodes doesn't need to keep the whole run in memory
+    # the database is still the complete record
+    # rows are batched into one transaction every few seconds by BufferedDataSaver, and written
+    # from a background thread so a slow disk doesn't hold up the control loop. The deadband only
+    # thins what goes to disk, live_store and most_recent_measurements still see every reading
+    with meas.run(in_memory_cache=False, write_in_background=True) as datasaver:
+        live_store = LiveStore(units={"faa_temperature": "K", "time": "s"})
+        world = StationWorld(station=st, live_store=live_store)
 
         global datasaver_global
         datasaver_global = datasaver
-        world.datasaver = datasaver
+        world.datasaver = BufferedDataSaver(datasaver, deadband=DeadbandFilter(STATION_DEADBANDS))
 
         states_list = [wait_forever, wait_forever2, switch_to_wait_forever_test, 
                     warmup_300K, full_cycle_one_state,
                     ready_for_cooldown, open_adr_heatswitch, set_relay_to_ramp]
         states_dict = {state.name(): state for state in states_list}
+        state_graph = module_state_graph(globals())
+        print(state_graph.report(states_list))
         world._update(wait_forever)
         dataset = datasaver.dataset
 
-        # Initialize the application and show the window
-        app = QApplication(sys.argv)
-        window = MyApp(world, dataset, states_dict)
-        window.show()
-        sys.exit(app.exec_())
+        # the kepco channels stream at 2 kHz alongside the 1 Hz log, any quench is saved at full rate
+        quench_capture = start_quench_capture(st.labjack, run_id=datasaver.run_id)
+        try:
+            # Initialize the application and show the window
+            app = QApplication(sys.argv)
+            window = MyApp(world, dataset, states_dict, state_graph=state_graph)
+            window.show()
+            sys.exit(app.exec_())
+        finally:
+            if quench_capture is not None:
+                quench_capture.stop()
 
 if __name__ == "__main__":
     main()
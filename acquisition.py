@@ -0,0 +1,208 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable
+import time
+
+import numpy as np
+
+
+def retry(f,n=3):
+    # try cryocon is being unreliable on returning temp, so try a few times then return nan
+    for i in range(n):
+        try:
+            return f()
+        except:
+            pass
+            # print(f"RETRYING {i=}")
+            # st.cryocon.write("CLR")
+            # time.sleep(0.1)
+    return np.nan
+
+
+@dataclass
+class AcquisitionEngine:
+    """
+    Reads groups of parameters concurrently, one worker thread per group.
+
+    Each group is a function taking a due(param) predicate and returning a list of
+    (parameter, value) pairs for the parameters that are due, in the form accepted by
+    datasaver.add_result. Put everything that shares a bus in the same group, the
+    groups then run in parallel so one tick takes as long as the slowest instrument
+    instead of the sum of all of them. Without rates every parameter is due every tick.
+    """
+    groups: dict[str, Callable[[Callable[[Any], bool]], list[tuple[Any, Any]]]]
+    rates: "SampleRates" = None
+    last_durations_s: dict[str, float] = field(default_factory=dict, init=False)
+    _executors: dict[str, ThreadPoolExecutor] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        # a single worker per group, so an instrument is only ever talked to from one thread
+        self._executors = {name: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"acquire_{name}")
+                           for name in self.groups.keys()}
+
+    def _timed_read(self, name, due):
+        tstart = time.time()
+        result = self.groups[name](due)
+        self.last_durations_s[name] = time.time()-tstart
+        return result
+
+    def _due_predicate(self, state_name, now_s):
+        if self.rates is None:
+            return lambda param: True
+        return lambda param: self.rates.due(result_name(param), now_s, state_name)
+
+    def _mark_read(self, results, now_s):
+        if self.rates is not None:
+            self.rates.mark_read([result_name(param) for param, value in results], now_s)
+
+    def acquire(self, state_name: str = None) -> list[tuple[Any, Any]]:
+        # state_name picks the ramp rates, see SampleRates
+        now_s = time.time()
+        due = self._due_predicate(state_name, now_s)
+        futures = [self._executors[name].submit(self._timed_read, name, due) for name in self.groups.keys()]
+        results = []
+        for future in futures:
+            results += future.result()  # re-raises anything the group didn't handle itself
+        self._mark_read(results, now_s)
+        return results
+
+    async def acquire_async(self, state_name: str = None) -> list[tuple[Any, Any]]:
+        # the same reads as acquire, awaited as asyncio tasks on the same per group workers
+        loop = asyncio.get_running_loop()
+        now_s = time.time()
+        due = self._due_predicate(state_name, now_s)
+        group_results = await asyncio.gather(*(loop.run_in_executor(self._executors[name], self._timed_read, name, due)
+                                               for name in self.groups.keys()))
+        results = [pair for results in group_results for pair in results]
+        self._mark_read(results, now_s)
+        return results
+
+    def close(self):
+        for executor in self._executors.values():
+            executor.shutdown(wait=True)
+
+
+@dataclass
+class SampleRates:
+    """
+    How often each parameter is read, in seconds between samples.
+
+    Parameters not in intervals_s are read every tick. While the state machine is in
+    one of ramp_states, ramp_intervals_s overrides intervals_s, so a parameter can be
+    read more often in the states named there. The names must match the states that
+    actually run, a state with another name gets intervals_s.
+    A parameter is due once its interval has passed since it was last read, with half
+    a tick of slack so tick jitter doesn't push it to the next tick.
+    This only saves bus time for a parameter read on its own. Where a group gets
+    several parameters from one query, e.g. the four cryocon channels or the AIN
+    packet, the query runs whenever any of them is due, and a longer interval only
+    drops values that were already read.
+    """
+    intervals_s: dict[str, float] = field(default_factory=dict)
+    ramp_intervals_s: dict[str, float] = field(default_factory=dict)
+    ramp_states: set[str] = field(default_factory=set)
+    tick_s: float = 1
+    last_read_s: dict[str, float] = field(default_factory=dict, init=False)
+
+    def interval_s(self, name: str, state_name: str = None) -> float:
+        if state_name in self.ramp_states and name in self.ramp_intervals_s:
+            return self.ramp_intervals_s[name]
+        return self.intervals_s.get(name, 0)
+
+    def due(self, name: str, now_s: float, state_name: str = None) -> bool:
+        if name not in self.last_read_s:
+            return True
+        return now_s-self.last_read_s[name] >= self.interval_s(name, state_name)-self.tick_s/2
+
+    def mark_read(self, names, now_s: float):
+        for name in names:
+            self.last_read_s[name] = now_s
+
+
+# logged name -> ls370 channel, each name also has to be registered with the Measurement
+LS370_THERMOMETERS = {"faa_temperature": "ch04"}
+
+
+def result_name(param) -> str:
+    # the name a (parameter, value) pair is stored under in the dataset
+    return param if isinstance(param, str) else param.full_name
+
+
+@dataclass
+class LatestValues:
+    """
+    The newest value of each logged parameter and the time it was read.
+
+    update() records every tick here, so readers such as most_recent_measurements get
+    the latest values without touching the dataset cache. Safe to read from the Qt
+    thread while the state thread writes.
+    """
+    _values: dict[str, tuple[Any, float]] = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def record(self, results: list[tuple[Any, Any]], timestamp: float = None):
+        if timestamp is None:
+            timestamp = time.time()
+        new_values = {result_name(param): (value, timestamp) for param, value in results}
+        with self._lock:
+            self._values.update(new_values)
+
+    def get(self, name: str) -> tuple[Any, float]:
+        # (value, timestamp), raises KeyError if name has never been recorded
+        with self._lock:
+            return self._values[name]
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {name: value for name, (value, timestamp) in self._values.items()}
+
+    def snapshot_with_time(self) -> dict[str, tuple[Any, float]]:
+        with self._lock:
+            return dict(self._values)
+
+
+def make_station_acquisition(st, rates: SampleRates = None) -> AcquisitionEngine:
+    # one group per bus: labjack on USB HID, cryocon on /dev/ttyUSB0, ls370 on /dev/ttyUSB1
+    # without rates everything is logged every tick: the cryocon channels and the AIN inputs each
+    # come in one query anyway, so all we could save is disk, and the deadband already thins that
+    def read_labjack(due):
+        analog_parameters = [st.labjack.kepco_current, st.labjack.kepco_voltage, st.labjack.he3_pressure]
+        parameters = analog_parameters+[st.labjack.relay, st.labjack.heatswitch_adr,
+                                        st.labjack.heatswitch_charcoal, st.labjack.heatswitch_pot]
+        if any(due(param) for param in analog_parameters):
+            # one packet for AIN0-2, the analog parameters below are served from this snapshot
+            retry(st.labjack.read_analog_inputs, n=1)
+        return [(param, retry(param, n=1)) for param in parameters if due(param)]
+
+    def read_cryocon(due):
+        cryocon_parameters = [st.cryocon.chA_temperature, st.cryocon.chB_temperature,
+                              st.cryocon.chC_temperature, st.cryocon.chD_temperature]
+        due_parameters = [due(param) for param in cryocon_parameters]
+        if not any(due_parameters):
+            return []
+        # one query for all four cryocon channels, retry returns a bare nan on failure
+        temperatures = retry(st.cryocon.temperatures, n=1)
+        if np.isscalar(temperatures):
+            temperatures = [np.nan]*len(cryocon_parameters)
+        return [(param, temperature) for param, temperature, is_due
+                in zip(cryocon_parameters, temperatures, due_parameters) if is_due]
+
+    def read_ls370(due):
+        results = []
+        if due(st.ls370.heater.out):
+            results.append((st.ls370.heater.out, retry(st.ls370.heater.out, n=1)))
+        names = [name for name in LS370_THERMOMETERS if due(name)]
+        if names:
+            # one transaction for all thermometers, channels without a new scan result come from the cache
+            temperatures = retry(lambda: st.ls370.read_channels([LS370_THERMOMETERS[name] for name in names]), n=1)
+            if temperatures is None or np.isscalar(temperatures):
+                temperatures = {LS370_THERMOMETERS[name]: np.nan for name in names}
+            results += [(name, temperatures[LS370_THERMOMETERS[name]]) for name in names]
+        return results
+
+    return AcquisitionEngine({"labjack": read_labjack,
+                              "cryocon": read_cryocon,
+                              "ls370": read_ls370},
+                             rates=rates)
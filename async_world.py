@@ -0,0 +1,180 @@
+import asyncio
+import sys
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import Any, Callable, Union
+
+import numpy as np
+
+from acquisition import AcquisitionEngine
+from imperative_statemachine import State
+from world_no_mpl import World, WaitUntil, WaitForInput
+
+# asyncio counterpart of World.state_runner, so a control loop, a logging loop and e.g. a status
+# server can share one event loop instead of each owning a thread
+#
+#     async def main():
+#         runner = AsyncWorldRunner(world, wait_forever)
+#         await asyncio.gather(runner.run(), some_status_server())
+#     asyncio.run(main())
+
+_instrument_locks = weakref.WeakKeyDictionary()
+
+
+def shared_instrument_lock() -> asyncio.Lock:
+    # one lock per event loop, shared by every runner on it that isn't given its own, so by default
+    # no two runners talk to the instruments at once. Made in the running loop, a lock made at import
+    # would be bound to the wrong loop on older pythons
+    loop = asyncio.get_running_loop()
+    if loop not in _instrument_locks:
+        _instrument_locks[loop] = asyncio.Lock()
+    return _instrument_locks[loop]
+
+
+async def readline_async() -> str:
+    # wait for a line on stdin without blocking the event loop, '' once stdin is closed
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def on_readable():
+        if not future.done():
+            future.set_result(sys.stdin.readline())
+
+    try:
+        loop.add_reader(sys.stdin, on_readable)
+    except (PermissionError, NotImplementedError):
+        # a regular file or /dev/null can't be watched (and always reads at once), nor can anything on windows
+        return await loop.run_in_executor(None, sys.stdin.readline)
+    try:
+        return await future
+    finally:
+        loop.remove_reader(sys.stdin)
+
+
+def _send(state_gen):
+    # StopIteration can't cross asyncio.to_thread, so report it as a value instead
+    try:
+        return False, state_gen.send(None)
+    except StopIteration as e:
+        return True, e.value
+
+
+@dataclass
+class AsyncWorldRunner:
+    """
+    Runs a World's states as asyncio tasks.
+
+    Ticks are their own task on a fixed grid, world.wait(...) becomes an asyncio sleep
+    until the deadline and world.wait_for_input(...) awaits stdin. With an acquisition
+    a tick awaits acquisition.acquire_async and hands the reads to world.record,
+    without one it runs world.update in a worker thread. State lines run in a worker
+    thread too. Both happen under instrument_lock, so the event loop stays responsive
+    and a tick and a state line never talk to the instruments at the same time. All
+    runners on an event loop share shared_instrument_lock() unless given a lock of their own.
+    """
+    world: World
+    state: State
+    on_line: Union[Callable[[State, int], Any], None] = None
+    acquisition: Union[AcquisitionEngine, None] = None
+    instrument_lock: Union[asyncio.Lock, None] = None
+    _lock: asyncio.Lock = field(default=None, init=False, repr=False)
+
+    async def _update(self):
+        world = self.world
+        if self.acquisition is None:
+            await asyncio.to_thread(world._update, self.state)
+            return
+        now = time.time()
+        results = await self.acquisition.acquire_async(self.state.name())
+        world.record(self.state, results)
+        if world.last_update_time_s is not None:
+            world.update_with_elapsed(elapsed_s=now-world.last_update_time_s)
+        world.last_update_time_s = now
+
+    def _drop_due_deadlines(self):
+        # world.wait and world._update still push deadlines for the synchronous runner, which pops
+        # them as they come due, pop them here the same way so the heap doesn't grow for the whole run
+        while self.world.scheduler.pop_next_due(time.time()) is not None:
+            pass
+
+    async def _tick_forever(self):
+        world = self.world
+        next_tick_s = np.ceil(time.time())
+        while True:
+            await asyncio.sleep(max(0, next_tick_s-time.time()))
+            async with self._lock:
+                await self._update()
+            self._drop_due_deadlines()
+            while next_tick_s <= time.time():
+                next_tick_s += world.target_tick_rate_s
+
+    async def _wait_for_command(self):
+        world = self.world
+        command = world.command
+        if isinstance(command, WaitUntil):
+            world.to_wait_for_process_line = command.time_s-time.time()
+            await asyncio.sleep(max(0, command.time_s-time.time()))
+            self._drop_due_deadlines()
+        elif isinstance(command, WaitForInput):
+            while True:
+                if world.scheduler.stdin_closed:
+                    # like the synchronous runner, the state waits for good but the ticks go on
+                    await asyncio.Event().wait()
+                line = await readline_async()
+                if line == "":
+                    print("stdin closed, no more input will arrive")
+                    world.scheduler.stdin_closed = True
+                    continue
+                line = line.strip()
+                print(f"got line! {command.target_input=}")
+                print(line)
+                if line == command.target_input:
+                    break
+        world.command = None
+
+    async def _run_states(self):
+        world = self.world
+        state_gen = self.state.func_to_make_generator(world)
+        while True:
+            async with self._lock:
+                done, value = await asyncio.to_thread(_send, state_gen)
+            if not done:
+                if self.on_line is not None:
+                    self.on_line(self.state, value)
+                if world.command is not None:
+                    await self._wait_for_command()
+                continue
+            next_state = value
+            world.on_state_change(self.state, next_state)
+            if next_state is None:
+                return
+            elif next_state != self.state:
+                world.state_start_time = time.time()
+            self.state = next_state
+            state_gen = self.state.func_to_make_generator(world)
+
+    async def run(self):
+        # returns when the states do, a failed tick cancels the states and raises its error here,
+        # so the magnet is never driven on without logging
+        world = self.world
+        world.command = None
+        world.state_start_time = time.time()
+        self._lock = self.instrument_lock if self.instrument_lock is not None else shared_instrument_lock()
+        async with self._lock:
+            await self._update()
+        tick_task = asyncio.create_task(self._tick_forever())
+        states_task = asyncio.create_task(self._run_states())
+        try:
+            await asyncio.wait([tick_task, states_task], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            tick_task.cancel()
+            states_task.cancel()
+            await asyncio.gather(tick_task, states_task, return_exceptions=True)
+        if states_task.cancelled():
+            tick_task.result()
+        states_task.result()
+
+
+async def run_worlds(*runners: AsyncWorldRunner):
+    await asyncio.gather(*(runner.run() for runner in runners))
@@ -0,0 +1,108 @@
+import argparse
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import qcodes as qc
+
+from run_cache import load_run, CACHE_DIR
+
+db_file_path = Path.home() / ".2pac_logs" / "2pac.db"
+
+SUMMARY_COLUMNS = ["run_id", "completed_timestamp", "n_samples", "cycle_duration_s",
+                   "min_faa_temperature_K", "min_pot_temperature_K", "pot_below_1K_s",
+                   "peak_magnet_current_A", "error"]
+
+
+def _column(run, name):
+    if name not in run.columns:
+        return None
+    return np.asarray(run.columns[name], dtype=float)
+
+
+def _nan_or(f, values):
+    if values is None or not np.any(np.isfinite(values)):
+        return np.nan
+    return float(f(values))
+
+
+def summarize_run(run_id, cache_dir=CACHE_DIR) -> dict:
+    """Per run numbers for comparing cycles, nan for anything the run didn't log."""
+    try:
+        run = load_run(run_id, cache_dir)
+    except Exception as e:
+        return {"run_id": run_id, "error": repr(e)}
+    t = _column(run, "time")
+    pot = _column(run, "cryocon_chD_temperature")
+    current = _column(run, "labjack_kepco_current")
+    pot_below_1K_s = np.nan
+    if pot is not None and len(pot) > 0:
+        # time spent below 1 K, each sample counts until the next one and the last until the
+        # end of the run. Against the pot's own setpoint, it may be sampled less often than time
+        pot_t = np.asarray(run.xy("cryocon_chD_temperature")[0], dtype=float)
+        pot_t = np.r_[pot_t, run.x_end("cryocon_chD_temperature")]
+        pot_below_1K_s = float(np.sum(np.diff(pot_t)[pot < 1]))
+    if t is None and pot is not None:
+        t = np.asarray(run.xy("cryocon_chD_temperature")[0], dtype=float)
+    return {"run_id": run_id,
+            "completed_timestamp": run.completed_timestamp,
+            "n_samples": 0 if t is None else len(t),
+            "cycle_duration_s": np.nan if t is None or len(t) == 0 else float(t[-1]-t[0]),
+            "min_faa_temperature_K": _nan_or(np.nanmin, _column(run, "faa_temperature")),
+            "min_pot_temperature_K": _nan_or(np.nanmin, pot),
+            "pot_below_1K_s": pot_below_1K_s,
+            "peak_magnet_current_A": _nan_or(lambda v: np.nanmax(np.abs(v)), current),
+            "error": ""}
+
+
+def _init_worker(db_location):
+    qc.config['core']['db_location'] = str(db_location)
+
+
+def summarize_runs(run_ids, db_location=db_file_path, cache_dir=CACHE_DIR, processes=None) -> list[dict]:
+    """
+    summarize_run over many runs in a process pool. Runs not yet in the columnar cache
+    are read from the database and cached on the way, so repeat comparisons are fast.
+    """
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(db_location,)) as executor:
+        return list(executor.map(summarize_run, run_ids, [cache_dir]*len(run_ids)))
+
+
+def write_summary(summaries, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        for summary in summaries:
+            writer.writerow(summary)
+
+
+def parse_run_ids(args):
+    # accepts single ids and inclusive ranges, e.g. 148 152 177-180
+    run_ids = []
+    for arg in args:
+        if "-" in arg:
+            first, last = arg.split("-")
+            run_ids += list(range(int(first), int(last)+1))
+        else:
+            run_ids.append(int(arg))
+    return run_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description="summarize and compare many 2pac runs")
+    parser.add_argument("run_ids", nargs="+", help="run ids or inclusive ranges like 177-197")
+    parser.add_argument("--out", default="run_summary.csv", help="csv file to write the summary table to")
+    parser.add_argument("--db", default=str(db_file_path))
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    summaries = summarize_runs(parse_run_ids(args.run_ids), db_location=args.db, processes=args.processes)
+    write_summary(summaries, args.out)
+    for summary in summaries:
+        print(summary)
+
+
+if __name__ == "__main__":
+    main()
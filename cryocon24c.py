@@ -1,3 +1,4 @@
+import threading
 from qcodes import VisaInstrument
 from qcodes.utils.validators import Numbers, Enum, Ints, Bool
 
@@ -14,17 +15,28 @@ def float_perc(x):
     if x[-1]  == "%":
         return float(strip(x[:-1]))
 
+def float_or_nan(x):
+    # the cryocon reports something like "......." for a channel without a valid reading
+    try:
+        return float(x)
+    except ValueError:
+        return float("nan")
+
 class Cryocon24C(VisaInstrument):
     """
     Driver for the Cryo-con Model 24 C temperature controller.
     """
+    CHANNELS = ['A', 'B', 'C', 'D']
+
     def __init__(self, name, address, terminator='\r\n', **kwargs):
+        # one command at a time, the logging thread and the state thread may both talk to us
+        self._comm_lock = threading.RLock()
         super().__init__(name, address, terminator=terminator, **kwargs)
         self.visa_handle.query_delay = 0.1 # cryocon has been unreliable on reruning temperatures
         # maybe a delay will help?
         # first pass says it doesn't help much
 
-        for channel in ['A', 'B', 'C', 'D']:
+        for channel in self.CHANNELS:
             c = 'ch{}_'.format(channel)
 
             self.add_parameter(c + 'temperature',
@@ -70,6 +82,14 @@ class Cryocon24C(VisaInstrument):
 
 
 
+        # all four temperatures in one semicolon chained query, so we pay the
+        # query_delay once instead of once per channel
+        self.add_parameter('temperatures',
+                           get_cmd=self._get_temperatures,
+                           unit="K",
+                           docstring="temperatures of channels A, B, C, D read in one query, "
+                           "also updates the cache of the chX_temperature parameters")
+
         # TODO: check case of returned strings
         self.add_parameter('control_enabled',
                            get_cmd='control?',
@@ -194,4 +214,23 @@ class Cryocon24C(VisaInstrument):
             raise ValueError()
         
     def _get_control_parser(self, x):
-        return {"ON":True, "OFF":False}[x]
\ No newline at end of file
+        return {"ON":True, "OFF":False}[x]
+
+    def write_raw(self, cmd):
+        with self._comm_lock:
+            super().write_raw(cmd)
+
+    def ask_raw(self, cmd):
+        with self._comm_lock:
+            return super().ask_raw(cmd)
+
+    def _get_temperatures(self):
+        query = ";".join(f"input? {channel}" for channel in self.CHANNELS)
+        response = self.ask(query)
+        values = response.split(";")
+        if len(values) != len(self.CHANNELS):
+            raise ValueError(f"expected {len(self.CHANNELS)} values from {query!r}, got {response!r}")
+        temperatures = [float_or_nan(v) for v in values]
+        for channel, temperature in zip(self.CHANNELS, temperatures):
+            self.parameters[f"ch{channel}_temperature"].cache.set(temperature)
+        return temperatures
@@ -1,5 +1,11 @@
 from dataclasses import dataclass, field
+from functools import cached_property
+import ast
+import hashlib
+import importlib.util
 import inspect
+import marshal
+import os
 from typing import Callable, Union
 
 
@@ -9,36 +15,169 @@ from typing import Callable, Union
 # https://stackoverflow.com/questions/427453/how-can-i-get-the-source-code-of-a-python-function
 
 
+def _returns(source: str) -> list[ast.Return]:
+    # the return statements of the state function itself, not of functions defined inside it
+    function_def = ast.parse(source).body[0]
+    returns = []
+    nodes = list(function_def.body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+            continue
+        if isinstance(node, ast.Return):
+            returns.append(node)
+        nodes.extend(ast.iter_child_nodes(node))
+    return sorted(returns, key=lambda node: (node.lineno, node.col_offset))
+
+
 def collect_exits(source: str) -> list[str]:
-    exits = []
-    for line in source.splitlines():
-        stripped = line.lstrip()  # Remove leading whitespace
-        if stripped.startswith("return"):  # Check if the line starts with "return"
-            after_return = stripped.split(" ", 1)[-1].strip()  # Split the line at the first space and take the rest
-            if after_return:  # If there's content after "return"
-                exits.append(after_return)  # Add the state name after "return" to the exits list
-            else:  # If it's a bare return
-                exits.append(None)  # Append None to indicate a bare return
-    return exits  # Return the list of exit states
-
-def insert_line_number_yields(source: str) -> str:
-    new_source = ""
-    i = 0
-    for line in source.splitlines():
-        new_source += f"{line}\n"
-        stripped = line.lstrip()
-        if not len(line)==0:
-            # if the line is empty, use the last value for n_leading_whitespace
-            n_leading_whitespace = len(line) - len(stripped)
-        if stripped.startswith("def") or stripped.startswith("for") or stripped.startswith("if") or stripped.startswith("while") or stripped.startswith("else") or stripped.startswith("elif"):
-            n_leading_whitespace += 4
-        whitespace = " " * n_leading_whitespace
-        if stripped.startswith("@") or stripped.startswith("#") or len(stripped)==0: # dont annotate decorator lines or comments
-            pass
-        else:
-            new_source += f"{whitespace}yield {i}\n"
-        i+=1
-    return new_source
+    # the text after each return, None for a bare return
+    return [None if node.value is None else ast.unparse(node.value) for node in _returns(source)]
+
+
+def _exit_targets(value: Union[ast.AST, None]) -> list[Union[str, None]]:
+    if value is None or (isinstance(value, ast.Constant) and value.value is None):
+        return [None]
+    if isinstance(value, ast.Name):
+        return [value.id]
+    if isinstance(value, ast.IfExp):  # return ramp_down if done else soak
+        return _exit_targets(value.body)+_exit_targets(value.orelse)
+    if isinstance(value, ast.BoolOp):  # return next_state or wait_forever
+        return [target for operand in value.values for target in _exit_targets(operand)]
+    return [ast.unparse(value)]  # anything else can't be resolved statically
+
+
+def _breaks_out_of(loop: ast.AST) -> bool:
+    # whether a break in loop's body ends loop itself, not a loop or function nested in it
+    nodes = list(loop.body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, ast.Break):
+            return True
+        if isinstance(node, (ast.For, ast.AsyncFor, ast.While, ast.FunctionDef, ast.AsyncFunctionDef,
+                             ast.ClassDef, ast.Lambda)):
+            nodes.extend(node.orelse if isinstance(node, (ast.For, ast.AsyncFor, ast.While)) else [])
+            continue
+        nodes.extend(ast.iter_child_nodes(node))
+    return False
+
+
+def _never_completes(node: ast.stmt) -> bool:
+    # True only when node surely doesn't carry on to the next statement, when unsure it may
+    if isinstance(node, (ast.Return, ast.Raise)):
+        return True
+    if isinstance(node, ast.If):
+        return _block_never_completes(node.body) and _block_never_completes(node.orelse)
+    if isinstance(node, ast.While):  # while True: without a break
+        return isinstance(node.test, ast.Constant) and bool(node.test.value) and not _breaks_out_of(node)
+    if isinstance(node, (ast.With, ast.AsyncWith)):
+        return _block_never_completes(node.body)
+    if isinstance(node, ast.Try):
+        if _block_never_completes(node.finalbody):
+            return True
+        return ((_block_never_completes(node.body) or _block_never_completes(node.orelse)) and
+                all(_block_never_completes(handler.body) for handler in node.handlers))
+    return False
+
+
+def _block_never_completes(statements: list[ast.stmt]) -> bool:
+    return any(_never_completes(node) for node in statements)
+
+
+def can_fall_through(source: str) -> bool:
+    # whether the state function can run off its end, which returns None and stops the state machine
+    return not _block_never_completes(ast.parse(source).body[0].body)
+
+
+def collect_exit_targets(source: str) -> list[Union[str, None]]:
+    """
+    The names each return can hand over to, None where the state machine stops,
+    including running off the end of the function without a return.
+    Expressions that aren't a plain name are kept as their text, see state_graph.
+    """
+    targets = []
+    for node in _returns(source):
+        for target in _exit_targets(node.value):
+            if target not in targets:
+                targets.append(target)
+    if can_fall_through(source) and None not in targets:
+        targets.append(None)
+    return targets
+
+
+def _calls_on(node: ast.AST, name: str) -> bool:
+    # whether node contains a call like name.method(...), name.attr.method(...) or helper(name, ...)
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call):
+            func = child.func
+            while isinstance(func, ast.Attribute):
+                func = func.value
+            arguments = child.args+[keyword.value for keyword in child.keywords]
+            if any(isinstance(n, ast.Name) and n.id == name for n in [func]+arguments):
+                return True
+    return False
+
+
+def _yield_line(line_index: int, location: ast.AST) -> ast.Expr:
+    return ast.copy_location(ast.Expr(ast.Yield(ast.Constant(line_index))), location)
+
+
+class StateYieldInserter(ast.NodeTransformer):
+    """
+    Turns a state function into a generator that yields the 0 based line index of the
+    source it just ran.
+
+    Yields go only where the state runner needs control back: once on entry, after
+    each statement that calls a method on the world (world.wait(), reads through
+    world.station, ...) and at the top of every loop iteration. Multi line statements,
+    try and with blocks and line continuations are handled like any other code, and
+    plain arithmetic runs without resuming the generator in between.
+    """
+
+    def __init__(self):
+        self.world_name = None
+
+    def visit_FunctionDef(self, node):
+        if self.world_name is not None:
+            return node  # a function defined inside a state runs as written
+        self.world_name = node.args.args[0].arg if node.args.args else "world"
+        node.decorator_list = []
+        node.body = [_yield_line(node.lineno-1, node)] + self._statements(node.body)
+        return node
+
+    def _statements(self, statements):
+        new_statements = []
+        for statement in statements:
+            new_statements.append(self._statement(statement))
+            if self._is_simple(statement) and _calls_on(statement, self.world_name):
+                new_statements.append(_yield_line(statement.lineno-1, statement))
+        return new_statements
+
+    @staticmethod
+    def _is_simple(statement):
+        return not hasattr(statement, "body") and not isinstance(statement, (ast.Return, ast.Raise))
+
+    def _statement(self, statement):
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+            return statement
+        for field_name in ("body", "orelse", "finalbody"):
+            statements = getattr(statement, field_name, None)
+            if statements:
+                setattr(statement, field_name, self._statements(statements))
+        for handler in getattr(statement, "handlers", []):
+            handler.body = self._statements(handler.body)
+        for case in getattr(statement, "cases", []):
+            case.body = self._statements(case.body)
+        if isinstance(statement, (ast.For, ast.While)):
+            # the back edge, each iteration hands control back, which also covers continue
+            statement.body = [_yield_line(statement.lineno-1, statement)] + statement.body
+        return statement
+
+
+def insert_state_yields(source: str) -> ast.Module:
+    tree = StateYieldInserter().visit(ast.parse(source))
+    return ast.fix_missing_locations(tree)
+
 
 def remove_decorators(source: str) -> str:
     lines = source.splitlines()
@@ -49,15 +188,70 @@ def remove_decorators(source: str) -> str:
             new_lines.append(line)
     return "\n".join(new_lines)
 
+# bump when the rewrite changes, so code cached by an older version is not used
+REWRITE_VERSION = 4
+
+
+def _state_cache_path(func, source: str) -> Union[str, None]:
+    # like __pycache__, next to the file defining the state, keyed by everything the compiled code depends on
+    source_file = inspect.getsourcefile(func)
+    if source_file is None:
+        return None
+    key_text = f"{REWRITE_VERSION}\n{__file__}\n{source_file}:{func.__code__.co_firstlineno}\n{source}"
+    key = hashlib.sha256(importlib.util.MAGIC_NUMBER + key_text.encode()).hexdigest()
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(source_file)), "__pycache__", "imperative_statemachine")
+    return os.path.join(cache_dir, f"{func.__name__}.{key[:32]}.marshal")
+
+
+def _load_cached(cache_path):
+    try:
+        with open(cache_path, "rb") as f:
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def _save_cached(cache_path, cached):
+    # write then rename so a concurrent launch never reads half a file, a read only tree just isn't cached
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            marshal.dump(cached, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+def compile_state_source(func, source: str):
+    """
+    Rewrite and compile the source of a state, returns (new_source, code, exits, exit_targets).
+
+    The result is cached on disk keyed by a hash of the source, so launching again
+    without editing a state skips the rewrite, the compile and the exit analysis.
+    """
+    cache_path = _state_cache_path(func, source)
+    cached = None if cache_path is None else _load_cached(cache_path)
+    if cached is not None:
+        return cached
+    tree = insert_state_yields(source)
+    new_source = ast.unparse(tree)
+    # the yields carry line indices into source, the code object gets the real file and line numbers
+    # so tracebacks point at the state as written. remove_decorators only drops lines above the def
+    source_file = inspect.getsourcefile(func) or "<state>"
+    n_decorator_lines = len(inspect.getsource(func).splitlines())-len(source.splitlines())
+    ast.increment_lineno(tree, func.__code__.co_firstlineno-1+n_decorator_lines)
+    new_code = compile(tree, source_file, "exec")
+    compiled = (new_source, new_code, collect_exits(source), collect_exit_targets(source))
+    if cache_path is not None:
+        _save_cached(cache_path, compiled)
+    return compiled
+
+
 # a decorator to create an imperative state from a function
 def state(func):
     source = remove_decorators(inspect.getsource(func))
-    new_source = insert_line_number_yields(source)
-    exits = collect_exits(source)
-    filename_for_errors = f"""virtual file created by imperative_statemachine for {func.__name__} in {__file__}
-
-{new_source}"""
-    new_code = compile(new_source, filename_for_errors, "exec")
+    new_source, new_code, exits, exit_targets = compile_state_source(func, source)
     # env = {}
     # exec(new_code, env)
     # exec(new_code)
@@ -65,7 +259,7 @@ def state(func):
     globals_from_func_definition = frame.f_globals  # Get the globals from where func was defined
     exec(new_code, globals_from_func_definition)  # Pass the globals from where func was defined
 
-    return State(exits, source, new_source, globals_from_func_definition[func.__name__])
+    return State(exits, source, new_source, globals_from_func_definition[func.__name__], exit_targets)
     
 def highlight_line(text: str, line_index: int) -> str:
     """
@@ -103,6 +297,7 @@ class State:
     raw_source: str
     new_source: str
     func_to_make_generator: Callable
+    exit_targets: list[Union[str, None]] = field(default_factory=list)
 
     def run_until_complete(self) -> tuple[list[int], Union['State', None]]:
         gen = self.func_to_make_generator()
@@ -124,11 +319,29 @@ class State:
     def name(self):
         return self.func_to_make_generator.__name__
     
+    @cached_property
+    def source_lines(self) -> list[str]:
+        return self.raw_source.split("\n")
+
+    @cached_property
+    def line_offsets(self) -> list[int]:
+        # character index in raw_source where each line starts
+        offsets = [0]
+        for line in self.source_lines[:-1]:
+            offsets.append(offsets[-1]+len(line)+1)
+        return offsets
+
+    @cached_property
+    def _highlighted(self) -> dict[int, str]:
+        return {}
+
     def code_line(self, line_number):
-        lines = self.raw_source.splitlines()
-        return lines[line_number]
+        return self.source_lines[line_number]
     
     def code_highlighted(self, line_number):
-        return highlight_line(self.raw_source, line_number)
+        # built once per line, a state sits on the same few lines for most of its ticks
+        if line_number not in self._highlighted:
+            self._highlighted[line_number] = highlight_line(self.raw_source, line_number)
+        return self._highlighted[line_number]
 
 
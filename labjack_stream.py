@@ -0,0 +1,191 @@
+import csv
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from live_store import RingBuffer
+
+STREAM_DIR = Path.home() / ".2pac_logs" / "stream"
+
+
+@dataclass
+class StreamCapture:
+    """
+    Runs U3 stream mode on a background thread into one ring buffer per channel.
+
+    channels maps a name to (AIN channel, scale), the buffers hold the scaled values,
+    e.g. the kepco voltage is twice the AIN0 voltage. The last buffer_s seconds are
+    kept at full rate. Every summary_every_s the min, mean and max of each channel go
+    to a csv file, and snapshot() saves the full rate samples around a moment to a
+    .npz file once the samples after it have arrived. Files are written from their
+    own thread so a slow disk never makes the stream fall behind the U3's buffer.
+    """
+    lj: Any
+    channels: dict[str, tuple[int, float]]
+    scan_frequency_hz: float = 2000
+    buffer_s: float = 60
+    summary_every_s: float = 1
+    out_dir: Path = STREAM_DIR
+    n_samples: int = field(default=0, init=False)  # per channel since the start, missed samples included
+    n_missed: int = field(default=0, init=False)
+    start_time_s: float = field(default=None, init=False)
+    summary_path: Path = field(default=None, init=False)
+    buffers: dict[str, RingBuffer] = field(default=None, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+    _stop: threading.Event = field(default_factory=threading.Event, init=False, repr=False)
+    _thread: threading.Thread = field(default=None, init=False, repr=False)
+    _writer: ThreadPoolExecutor = field(default=None, init=False, repr=False)
+    _pending_snapshots: list = field(default_factory=list, init=False, repr=False)
+    _summary: dict[str, list] = field(default_factory=dict, init=False, repr=False)
+    _next_summary_index: int = field(default=0, init=False, repr=False)
+
+    def __post_init__(self):
+        capacity = int(self.buffer_s*self.scan_frequency_hz)
+        self.buffers = {name: RingBuffer(capacity) for name in self.channels}
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, comm_lock):
+        # comm_lock is the instrument's, stream config and start are ordinary commands
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self._stop.clear()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stream_writer")
+        ains = [ain for ain, scale in self.channels.values()]
+        with comm_lock:
+            self.lj.streamConfig(NumChannels=len(ains), PChannels=ains, NChannels=[31]*len(ains),
+                                 ScanFrequency=self.scan_frequency_hz)
+            self.lj.streamStart()
+        self.start_time_s = time.time()
+        self.summary_path = self.out_dir / f"stream_summary_{self.start_time_s:.0f}.csv"
+        self._next_summary_index = int(self.summary_every_s*self.scan_frequency_hz)
+        self._thread = threading.Thread(target=self._run, args=(comm_lock,), name="labjack_stream", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+
+    def _run(self, comm_lock):
+        try:
+            for packet in self.lj.streamData():
+                if self._stop.is_set():
+                    break
+                if packet is None:
+                    continue  # no data yet
+                self._add_packet(packet)
+        except Exception:
+            print("labjack stream stopped")
+            traceback.print_exc()
+        finally:
+            with comm_lock:
+                self.lj.streamStop()
+
+    def _add_packet(self, packet):
+        missed_scans = packet["missed"]//len(self.channels)
+        if missed_scans:
+            # keep sample times right by padding the gap, the samples themselves are lost
+            self._extend({name: np.full(missed_scans, np.nan) for name in self.channels})
+            self.n_missed += missed_scans
+        self._extend({name: np.asarray(packet[f"AIN{ain}"])*scale for name, (ain, scale) in self.channels.items()})
+        self._summarize()
+        self._save_due_snapshots()
+
+    def _extend(self, values):
+        n = len(next(iter(values.values())))
+        with self._lock:
+            for name, v in values.items():
+                self.buffers[name].extend(v)
+                self._summary.setdefault(name, []).append(v)
+            self.n_samples += n
+
+    def sample_time_s(self, index) -> float:
+        return self.start_time_s+index/self.scan_frequency_hz
+
+    def sample_index(self, time_s) -> int:
+        return int(round((time_s-self.start_time_s)*self.scan_frequency_hz))
+
+    def latest(self) -> dict[str, float]:
+        # the newest sample of each channel, nan before the first packet
+        with self._lock:
+            return {name: buffer.tail(1)[0] if len(buffer) else np.nan for name, buffer in self.buffers.items()}
+
+    def window(self, start_index, stop_index) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        # (times, values by channel) for samples start_index up to stop_index, as far as they are still buffered
+        with self._lock:
+            first_buffered = self.n_samples-len(next(iter(self.buffers.values())))
+            start_index = max(start_index, first_buffered)
+            stop_index = min(stop_index, self.n_samples)
+            n = max(stop_index-start_index, 0)
+            values = {name: buffer.tail(self.n_samples-start_index)[:n] for name, buffer in self.buffers.items()}
+        times = self.sample_time_s(start_index+np.arange(n))
+        return times, values
+
+    def means_since(self, start_index) -> tuple[dict[str, float], int]:
+        """
+        The mean of each channel over the samples from start_index to the newest one,
+        missed samples left out, and the index to pass next time to continue from there.
+        With no new samples the newest one is used.
+        """
+        stop_index = self.n_samples
+        times, values = self.window(min(start_index, stop_index-1), stop_index)
+        means = {name: np.nanmean(v) if np.any(np.isfinite(v)) else np.nan for name, v in values.items()}
+        return means, stop_index
+
+    def _summarize(self):
+        if self.n_samples < self._next_summary_index:
+            return
+        with self._lock:
+            chunks = {name: np.concatenate(v) for name, v in self._summary.items()}
+            self._summary = {}
+        time_s = self.sample_time_s(self.n_samples)
+        self._next_summary_index = self.n_samples+int(self.summary_every_s*self.scan_frequency_hz)
+        self._writer.submit(self._write_summary, time_s, chunks)
+
+    def _write_summary(self, time_s, chunks):
+        new_file = not self.summary_path.exists()
+        with open(self.summary_path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(["time"]+[f"{name}_{stat}" for name in chunks for stat in ("min", "mean", "max")])
+            row = [f"{time_s:.3f}"]
+            for v in chunks.values():
+                if np.any(np.isfinite(v)):
+                    row += [np.nanmin(v), np.nanmean(v), np.nanmax(v)]
+                else:
+                    row += [np.nan]*3
+            writer.writerow(row)
+
+    def snapshot(self, time_s, pre_s, post_s, label="manual", on_saved=None):
+        """
+        Save the full rate samples from pre_s before time_s to post_s after it, once
+        they have all been streamed. on_saved(path) is called from the writer thread.
+        """
+        with self._lock:
+            self._pending_snapshots.append((self.sample_index(time_s-pre_s), self.sample_index(time_s+post_s),
+                                            time_s, label, on_saved))
+
+    def _save_due_snapshots(self):
+        with self._lock:
+            due = [s for s in self._pending_snapshots if s[1] <= self.n_samples]
+            self._pending_snapshots = [s for s in self._pending_snapshots if s[1] > self.n_samples]
+        for start_index, stop_index, time_s, label, on_saved in due:
+            times, values = self.window(start_index, stop_index)
+            self._writer.submit(self._write_snapshot, time_s, label, times, values, on_saved)
+
+    def _write_snapshot(self, time_s, label, times, values, on_saved):
+        path = self.out_dir / f"snapshot_{time_s:.3f}_{label}.npz"
+        np.savez(path, time=times, trigger_time=time_s, label=label,
+                 scan_frequency_hz=self.scan_frequency_hz, **values)
+        if on_saved is not None:
+            on_saved(path)
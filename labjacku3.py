@@ -1,14 +1,78 @@
+import atexit
+import queue
+import traceback
 import qcodes
 import u3
 import time
+import threading
 from qcodes.validators import Enum, Numbers
 
+from labjack_stream import StreamCapture
+
+PSI_TO_BAR = 0.0689476
+# what stream mode captures, name -> (AIN channel, volts to value), the same conversions as the get_ functions
+STREAM_CHANNELS = {"kepco_voltage": (0, 2),
+                   "he3_pressure": (1, 50*PSI_TO_BAR),
+                   "kepco_current": (2, 1)}
+
+
+class PulseScheduler:
+    """
+    Runs digital pulses on a worker thread so whoever asks for one doesn't wait for it.
+
+    Each pulse sets a line high, holds it, sets it low and then waits settle_s before
+    the next pulse starts, so the hardware sees the same sequence of edges as when
+    the pulses were done inline, one after the other, in the order they were asked for.
+    """
+    def __init__(self, set_state):
+        self._set_state = set_state
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="labjack_pulses", daemon=True)
+        self._thread.start()
+        # don't let the interpreter exit with a line left high
+        atexit.register(self.wait)
+
+    def pulse(self, ch, high_s, settle_s=0):
+        self._queue.put((ch, high_s, settle_s))
+
+    def wait(self):
+        # block until every pulse asked for so far has finished
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            ch, high_s, settle_s = self._queue.get()
+            try:
+                try:
+                    self._set_state(ch, "high")
+                    time.sleep(high_s)
+                finally:
+                    self._set_state(ch, "low")
+                time.sleep(settle_s)
+            except Exception:
+                print(f"labjack pulse on {ch} failed")
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
 
 
 class LabjackU3(qcodes.Instrument):
     def __init__(self, name):
         super().__init__(name)
         self.lj = u3.U3() # Opens first found u3 over USB
+        # one USB transaction at a time, the logging thread and the state thread may both talk to us
+        self._comm_lock = threading.RLock()
+        # heat switch and relay pulses return right away, the low edge is sent from this worker
+        self.pulses = PulseScheduler(self.setDigIOState)
+        # AIN0-2 are read together in one feedback packet, the kepco and he3 parameters
+        # are served from that snapshot while it is younger than analog_max_age_s
+        self.analog_channels = (0, 1, 2)
+        self.analog_max_age_s = 0.25
+        self._analog_snapshot = None
+        self._analog_snapshot_time_s = -float("inf")
+        self.stream = None
+        self._stream_read_index = 0
 
         self.add_parameter("relay",
                            set_cmd=self.set_relay,
@@ -46,16 +110,51 @@ class LabjackU3(qcodes.Instrument):
     def get_idn(self) -> dict[str, str | int | None]:
         return "a labjack u3"
 
+    def _get_ain(self, n):
+        with self._comm_lock:
+            return self.lj.getAIN(n)
+
+    def _feedback(self, *commands):
+        with self._comm_lock:
+            return self.lj.getFeedback(*commands)
+
+    def read_analog_inputs(self) -> dict[int, float]:
+        '''Sample all analog_channels single ended in one USB round trip, in volts by channel.
+        Calibrated the same way getAIN does it, AIN0-3 are high voltage inputs on a U3-HV.
+        While streaming the U3 can't answer analog reads, instead each channel is the mean of the
+        samples streamed since the previous call, which is quieter than any single stream sample.'''
+        if self.stream is not None and self.stream.running:
+            means, self._stream_read_index = self.stream.means_since(self._stream_read_index)
+            volts = {ain: means[name]/scale for name, (ain, scale) in self.stream.channels.items()}
+            with self._comm_lock:
+                self._analog_snapshot = volts
+                self._analog_snapshot_time_s = time.monotonic()
+            return volts
+        with self._comm_lock:
+            bits = self.lj.getFeedback(*[u3.AIN(ch) for ch in self.analog_channels])
+            volts = {ch: self.lj.binaryToCalibratedAnalogVoltage(b, isLowVoltage=not (getattr(self.lj, "isHV", False) and ch < 4),
+                                                                  isSingleEnded=True, isSpecialSetting=False, channelNumber=ch)
+                     for ch, b in zip(self.analog_channels, bits)}
+            self._analog_snapshot = volts
+            self._analog_snapshot_time_s = time.monotonic()
+        return volts
+
+    def analog_snapshot(self) -> dict[int, float]:
+        # the last bulk read if it is recent enough, so the parameters read in one tick come from one instant
+        with self._comm_lock:
+            if time.monotonic()-self._analog_snapshot_time_s < self.analog_max_age_s:
+                return self._analog_snapshot
+            return self.read_analog_inputs()
+
     def get_kepco_voltage(self):
-        return self.lj.getAIN(0)*2
+        return self.analog_snapshot()[0]*2
 
     def get_kepco_current(self):
-        return self.lj.getAIN(2)
+        return self.analog_snapshot()[2]
     
     def get_he3_pressure(self, VDC_TO_PSIA=50):
         # Omega PX409-250 strain gauge output full range = 0-5 Vdc for 0-250 psi abs
-        PSI_TO_BAR = 0.0689476
-        return self.lj.getAIN(1)*VDC_TO_PSIA*PSI_TO_BAR
+        return self.analog_snapshot()[1]*VDC_TO_PSIA*PSI_TO_BAR
 
     def set_relay(self, x):
         if x == "CONTROL":
@@ -67,19 +166,19 @@ class LabjackU3(qcodes.Instrument):
     def setDACVoltage(self, dac_channel, voltage):
         dac_value = int(voltage * 255/4.95)
         if dac_channel == 0:
-            self.lj.getFeedback(u3.DAC0_8(dac_value))
+            self._feedback(u3.DAC0_8(dac_value))
         elif dac_channel == 1:
-            self.lj.getFeedback(u3.DAC1_8(dac_value))
+            self._feedback(u3.DAC1_8(dac_value))
         else:
             print('Error: Not a channel')
 
-    def setRelayControl(self, io_channel):
-        '''Turn on digital io channel for 2 seconds then turn back off to switch latching relay '''
+    def setRelayControl(self, io_channel, blocking=False):
+        '''Turn on digital io channel for 0.2 seconds then turn back off to switch latching relay,
+        then give it 0.5 seconds to settle before the next pulse '''
         
-        self.setDigIOState(io_channel=io_channel, state='high')
-        time.sleep(0.2)
-        self.setDigIOState(io_channel=io_channel, state='low')
-        time.sleep(0.5)
+        self.pulses.pulse(io_channel, high_s=0.2, settle_s=0.5)
+        if blocking:
+            self.pulses.wait()
         
     def setRelayToRamp(self, io_channel=16):
         '''Switch relay to ramp mode. Default assumes ramp setting is on io=4.'''
@@ -95,16 +194,41 @@ class LabjackU3(qcodes.Instrument):
         '''Set the state of a Digital IO Channel '''
         
         if state == 'high':
-            self.lj.getFeedback(u3.BitStateWrite(io_channel, 1))   # Set IO channel to high
+            self._feedback(u3.BitStateWrite(io_channel, 1))   # Set IO channel to high
         elif state == 'low':
-            self.lj.getFeedback(u3.BitStateWrite(io_channel, 0))   # Set IO channel to low
+            self._feedback(u3.BitStateWrite(io_channel, 0))   # Set IO channel to low
         else:
             print('Error: Direction not valid')
 
-    def pulse_digital_state(self,ch, sleep_s=0.1):
-        self.setDigIOState(ch, "high")
-        time.sleep(sleep_s)
-        self.setDigIOState(ch, "low")
+    def pulse_digital_state(self,ch, sleep_s=0.1, blocking=False):
+        self.pulses.pulse(ch, high_s=sleep_s)
+        if blocking:
+            self.pulses.wait()
+
+    def start_stream(self, scan_frequency_hz=2000, channels=STREAM_CHANNELS, **kwargs):
+        '''Capture channels at scan_frequency_hz in the background, see labjack_stream.StreamCapture.
+        The parameters keep working, from the streamed samples.'''
+        if self.stream is not None and self.stream.running:
+            return self.stream
+        stream = StreamCapture(self.lj, channels, scan_frequency_hz=scan_frequency_hz, **kwargs)
+        try:
+            stream.start(self._comm_lock)
+        except Exception:
+            # e.g. streamConfig refused, the analog parameters stay on feedback reads
+            stream.stop()
+            raise
+        self._stream_read_index = 0
+        self.stream = stream
+        return self.stream
+
+    def stop_stream(self):
+        if self.stream is not None:
+            self.stream.stop()
+
+    def close(self):
+        self.stop_stream()
+        self.pulses.wait()
+        super().close()
 
     def _pot_hs_control(self, x):
         if x =="OPEN":
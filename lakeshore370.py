@@ -1,3 +1,6 @@
+import math
+import time
+from dataclasses import dataclass, field
 from typing import Any, ClassVar
 
 from pyvisa.highlevel import ResourceManager
@@ -16,6 +19,61 @@ from bisect import bisect
 # There are 16 sensors channels (a.k.a. measurement inputs) in Model 372
 _n_channels = 16
 
+# query per reading quantity, see LakeshoreModel370.read_channels
+READING_COMMANDS: dict[str, str] = {"temperature": "RDGK?", "sensor_raw": "RDGR?"}
+
+
+@dataclass
+class ScannerModel:
+    """
+    When the scanner will next have a new reading for a channel.
+
+    The 370 measures one channel at a time. After switching to a channel it waits
+    the channel's pause time, then updates the reading about every reading_interval_s
+    for the dwell time, then with autoscan on moves to the next enabled channel.
+    A channel the scanner isn't on keeps returning its last reading. timing holds
+    (pause_s, dwell_s) for each enabled channel, current and arrived_s where the
+    scanner was last seen and since when, seen_s when it was last looked at.
+    """
+    timing: dict[int, tuple[float, float]] = field(default_factory=dict)
+    autoscan: bool = False
+    current: int = None
+    arrived_s: float = -math.inf
+    seen_s: float = -math.inf
+    reading_interval_s: float = 1
+
+    def observe(self, channel: int, autoscan: bool, now_s: float):
+        # from SCAN?. The scanner moved some time after seen_s, assume as early as that, but no earlier
+        # than settled just now: on the first look or after missed looks it may have been there all along
+        if channel != self.current:
+            pause_s = self.timing.get(channel, (0, 0))[0]
+            self.current, self.arrived_s = channel, max(self.seen_s, now_s-pause_s)
+        self.seen_s = now_s
+        self.autoscan = autoscan
+
+    def next_reading_s(self, channel: int, read_s: float) -> float:
+        """The time a reading of channel newer than one taken at read_s is available."""
+        if self.current is None:
+            return read_s  # nothing known about the scanner yet
+        if channel == self.current:
+            pause_s, dwell_s = self.timing.get(channel, (0, 0))
+            settled_s = self.arrived_s+pause_s
+            if not self.autoscan or read_s < settled_s+dwell_s:
+                return max(read_s+self.reading_interval_s, settled_s)
+        if not self.autoscan or channel not in self.timing:
+            return math.inf  # the scanner isn't coming to it
+        # walk the scan cycle from the current channel to the end of channel's first visit after read_s
+        order = sorted(self.timing)
+        i = order.index(self.current) if self.current in order else 0
+        end_s = self.arrived_s
+        for k in range(2*len(order)+1):
+            scanned = order[(i+k) % len(order)]
+            pause_s, dwell_s = self.timing[scanned]
+            end_s += pause_s+dwell_s
+            if scanned == channel and end_s > read_s:
+                return end_s
+        return read_s
+
 
 class LakeshoreModel370Output(InstrumentChannel):
     """An InstrumentChannel for control outputs (heaters) of Lakeshore Model 372"""
@@ -409,6 +467,11 @@ class LakeshoreModel370Channel(BaseSensorChannel):
         #     get_cmd=f"INTYPE? {self._channel}",
         # )
 
+    def _get_temperature(self) -> float:
+        # the scanner only produces a new reading when it visits this channel, in between
+        # the last reading is served without touching the serial link, see ScannerModel
+        return self.parent.read_channels([self.short_name])[self.short_name]
+
 
 class LakeshoreModel370(LakeshoreBase):
     """
@@ -432,6 +495,71 @@ class LakeshoreModel370(LakeshoreBase):
 
         self.add_submodule("heater", LakeshoreModel370Output(self, output_name="heater"))
 
+        # bulk readings, see read_channels
+        self.scanner = ScannerModel()
+        # whether the 370 takes several queries joined by ";" in one message, else they are asked one by one
+        self.chain_queries = True
+        # re-query at least this often even if the scanner model says nothing changed,
+        # in case the scanner was changed from the front panel
+        self.reading_max_age_s = 60
+        self._readings: dict[tuple[str, str], tuple[float, float]] = {}
+
+    def _ask_chained(self, queries: list[str]) -> list[str]:
+        with self._comm_lock:
+            if not self.chain_queries:
+                return [self.ask(query) for query in queries]
+            responses = self.ask(";".join(queries)).split(";")
+        if len(responses) != len(queries):
+            raise ValueError(f"expected {len(queries)} responses to {queries}, got {responses}")
+        return [response.strip() for response in responses]
+
+    def refresh_scanner_timing(self):
+        """Read the INSET group (enabled, dwell, pause) of every channel into the scanner model."""
+        for channel in self.channels:
+            channel.output_group.update()
+        self._update_scanner_timing()
+
+    def _update_scanner_timing(self):
+        self.scanner.timing = {int(channel._channel): (channel.pause.get_latest(), channel.dwell.get_latest())
+                               for channel in self.channels if channel.enabled.get_latest()}
+
+    def reading_due(self, name: str, quantity: str = "temperature", now_s: float = None) -> bool:
+        # whether the scanner has a newer reading of channel name than the one we have
+        if (name, quantity) not in self._readings:
+            return True
+        if now_s is None:
+            now_s = time.time()
+        value, read_s = self._readings[(name, quantity)]
+        if now_s-read_s >= self.reading_max_age_s:
+            return True
+        return now_s >= self.scanner.next_reading_s(int(self.channel_name_command[name]), read_s)
+
+    def read_channels(self, names: list[str], quantity: str = "temperature") -> dict[str, float]:
+        """
+        Read quantity ("temperature" or "sensor_raw") of the channels with the given
+        names, e.g. ["ch04", "ch06"], in one serial transaction.
+
+        Only channels the scanner has a new reading for are queried, see ScannerModel,
+        the others are served from the last reading. SCAN? is asked in the same
+        transaction, so every bulk read keeps the scanner model up to date.
+        """
+        with self._comm_lock:
+            if self.channels[0].dwell.cache.timestamp is None:  # never read, get_latest would read just this group
+                self.refresh_scanner_timing()
+            else:
+                self._update_scanner_timing()  # dwell or pause may have been set since
+            now_s = time.time()
+            due = [name for name in names if self.reading_due(name, quantity, now_s)]
+            if due:
+                queries = [f"{READING_COMMANDS[quantity]} {self.channel_name_command[name]}" for name in due]
+                responses = self._ask_chained(queries+["SCAN?"])
+                read_s = time.time()
+                for name, response in zip(due, responses):
+                    self._readings[(name, quantity)] = (float(response), read_s)
+                scan_channel, autoscan = responses[-1].split(",")
+                self.scanner.observe(int(scan_channel), autoscan.strip() == "1", read_s)
+            return {name: self._readings[(name, quantity)][0] for name in names}
+
     def _open_resource(self, address: str, visalib: str | None) -> tuple[MessageBasedResource, str, ResourceManager]:
         # first call the existing _open_resource method
         resource, visabackend, resource_manager = super()._open_resource(address, visalib)
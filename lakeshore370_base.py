@@ -1,3 +1,4 @@
+import threading
 import time
 from bisect import bisect
 from collections.abc import Sequence
@@ -357,7 +358,7 @@ class BaseSensorChannel(InstrumentChannel):
         # Add the various channel parameters
 
         self.add_parameter('temperature',
-                           get_cmd=f'RDGK? {self._channel}',
+                           get_cmd=self._get_temperature,
                            get_parser=float,
                            label='Temperature',
                            unit='K')
@@ -392,6 +393,10 @@ class BaseSensorChannel(InstrumentChannel):
         #                    vals=vals.Strings(15),
         #                    label='Sensor name')
 
+    def _get_temperature(self) -> str:
+        # a subclass can serve this from a cache, see LakeshoreModel370Channel
+        return self.ask(f'RDGK? {self._channel}')
+
     def _decode_sensor_status(self, sum_of_codes: str) -> str:
         """
         Parses the sum of status code according to the `SENSOR_STATUSES` using
@@ -494,6 +499,8 @@ class LakeshoreBase(VisaInstrument):
         print_connect_message: bool = True,
         **kwargs: Any,
     ) -> None:
+        # one command at a time, the logging thread and the state thread may both talk to us
+        self._comm_lock = threading.RLock()
         super().__init__(name, address, terminator=terminator, **kwargs)
 
         # Allow access to channels either by referring to the channel name
@@ -515,4 +522,12 @@ class LakeshoreBase(VisaInstrument):
         # on Model335 we need to change serial port settings
         # before we can communicate
         if print_connect_message:
-            self.connect_message()
\ No newline at end of file
+            self.connect_message()
+
+    def write_raw(self, cmd: str) -> None:
+        with self._comm_lock:
+            super().write_raw(cmd)
+
+    def ask_raw(self, cmd: str) -> str:
+        with self._comm_lock:
+            return super().ask_raw(cmd)
@@ -0,0 +1,335 @@
+import numpy as np
+from dataclasses import dataclass, field
+from typing import Any
+
+# the text parameters drawn as horizontal state bars, and their categories in the order
+# they are encoded (dark, light, grey)
+STATE_KEYS = {"labjack_heatswitch_adr": ("CLOSED", "OPEN", "UNKNOWN"),
+              "labjack_heatswitch_charcoal": ("CLOSED", "OPEN", "UNKNOWN"),
+              "labjack_heatswitch_pot": ("CLOSED", "OPEN", "UNKNOWN"),
+              "labjack_relay": ("RAMP", "CONTROL", "UNKNOWN")}
+
+
+@dataclass
+class GrowingArray:
+    """A numpy array with amortized O(1) append, the capacity doubles as needed."""
+    dtype: Any = float
+    n: int = field(default=0, init=False)
+    _data: np.ndarray = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        self._data = np.empty(1024, dtype=self.dtype)
+
+    def extend(self, values):
+        values = np.asarray(values)
+        if self.n+len(values) > len(self._data):
+            new_data = np.empty(max(2*len(self._data), self.n+len(values)), dtype=self.dtype)
+            new_data[:self.n] = self._data[:self.n]
+            self._data = new_data
+        self._data[self.n:self.n+len(values)] = values
+        self.n += len(values)
+
+    def view(self):
+        return self._data[:self.n]
+
+    def __len__(self):
+        return self.n
+
+
+@dataclass
+class StateRuns:
+    """
+    Run length encoding of a text parameter as integer category codes.
+
+    Only the x where each run starts and its code are stored, so memory and the cost
+    of drawing scale with the number of transitions, not the number of samples.
+    Values not in categories are appended to it as they show up.
+    """
+    categories: list[str]
+    starts: GrowingArray = field(default_factory=GrowingArray, init=False)
+    codes: GrowingArray = field(default_factory=lambda: GrowingArray(dtype=int), init=False)
+    x_end: float = field(default=np.nan, init=False)
+
+    def encode(self, values):
+        uniques, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        for value in uniques:
+            if value not in self.categories:
+                self.categories.append(value)
+        lookup = np.array([self.categories.index(value) for value in uniques], dtype=int)
+        return lookup[inverse]
+
+    def extend(self, x, values):
+        if len(values) == 0:
+            return
+        codes = self.encode(values)
+        last_code = self.codes.view()[-1] if len(self.codes) > 0 else -1
+        changes = codes != np.r_[last_code, codes[:-1]]
+        self.starts.extend(np.asarray(x)[changes])
+        self.codes.extend(codes[changes])
+        self.x_end = x[-1]
+
+    def intervals(self):
+        # (start, width) of each run, the last run extends to the latest sample
+        starts = self.starts.view()
+        return np.column_stack([starts, np.diff(np.r_[starts, self.x_end])]), self.codes.view()
+
+
+def minmax_decimate(x, y, xmin, xmax, n_buckets):
+    """
+    Reduce x, y to the min and max of y in each of n_buckets equal width x buckets
+    spanning xmin..xmax, plus one point either side so lines run off the edges.
+
+    x must be sorted. With n_buckets set to the width of the axes in pixels the
+    result looks the same as the full data, but has at most 2*n_buckets points.
+    """
+    i0 = max(np.searchsorted(x, xmin)-1, 0)
+    i1 = min(np.searchsorted(x, xmax)+1, len(x))
+    x, y = x[i0:i1], y[i0:i1]
+    if len(x) <= 2*n_buckets or xmax <= xmin:
+        return x, y
+    bucket = np.clip(np.floor((x-xmin)/(xmax-xmin)*n_buckets).astype(int), -1, n_buckets)
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:]-1, len(x)-1]
+    # fmin/fmax skip nan, so a bucket is only a gap if it has no valid samples
+    y_min = np.fmin.reduceat(y, starts)
+    y_max = np.fmax.reduceat(y, starts)
+    return np.column_stack([x[starts], x[ends]]).ravel(), np.column_stack([y_min, y_max]).ravel()
+
+
+@dataclass
+class DecimatedLine:
+    """
+    A Line2D that holds the full data but only draws its min/max decimation over the
+    visible x range, call connect_decimation so it is recomputed on zoom and pan.
+    """
+    line: Any
+    x: np.ndarray = field(default_factory=lambda: np.empty(0))
+    y: np.ndarray = field(default_factory=lambda: np.empty(0))
+
+    def set_data(self, x, y):
+        self.x, self.y = x, y
+        self.redecimate()
+
+    def redecimate(self):
+        ax = self.line.axes
+        xmin, xmax = ax.get_xlim()
+        n_buckets = max(int(ax.bbox.width), 1)  # one bucket per pixel column
+        self.line.set_data(*minmax_decimate(self.x, self.y, xmin, xmax, n_buckets))
+
+
+def connect_decimation(ax, decimated_lines):
+    def on_xlim_changed(ax):
+        for decimated_line in decimated_lines:
+            decimated_line.redecimate()
+    return ax.callbacks.connect("xlim_changed", on_xlim_changed)
+
+
+def decimated_plot_dataset(dataset, axes):
+    """
+    A stand in for qcodes plot_dataset on a live run, plots each parameter that has a
+    setpoint on its own axes with min/max decimation.
+    """
+    data = dataset.cache.data()
+    param_specs = {param_spec.name: param_spec for param_spec in dataset.get_parameters()}
+    keys = [key for key in data.keys() if len(data[key]) > 1 and param_specs[key].type == "numeric"]
+    for ax, key in zip(axes, keys):
+        setpoint_key = [k for k in data[key].keys() if k != key][0]
+        x = np.asarray(data[key][setpoint_key], dtype=float)
+        y = np.asarray(data[key][key], dtype=float)
+        # deadbanded parameters only log changes, each value holds until the next sample
+        (line,) = ax.plot([], [], drawstyle="steps-post")
+        decimated_line = DecimatedLine(line)
+        if len(x) > 0:
+            ax.set_xlim(x[0], max(x[-1], x[0]+1))
+        decimated_line.set_data(x, y)
+        ax.relim()
+        ax.autoscale_view(scalex=False)
+        connect_decimation(ax, [decimated_line])
+        setpoint_spec, spec = param_specs[setpoint_key], param_specs[key]
+        ax.set_xlabel(f"{setpoint_spec.label or setpoint_key} ({setpoint_spec.unit})")
+        ax.set_ylabel(f"{spec.label or key} ({spec.unit})")
+
+
+# eq=False keeps the default identity hash, the canvas callbacks hold on to bound methods of it
+@dataclass(eq=False)
+class IncrementalLivePlot:
+    """
+    Live plot of the logged parameters in a LiveStore that keeps its artists between
+    updates.
+
+    Lines are created on the first update, afterwards their data is swapped for the
+    store's bounded columns and they are redrawn by blitting over a cached background.
+    A full draw only happens when the data outgrows the current limits, or when
+    matplotlib redraws on its own (resize, zoom, pan). Lines are min/max decimated to
+    the visible x range, so drawing is bounded by the width of the axes rather than
+    the length of the run.
+    """
+    ax: Any
+    canvas: Any
+    state_keys: dict[str, tuple[str, str, str]] = field(default_factory=lambda: dict(STATE_KEYS))
+    n_seen: int = field(default=0, init=False)
+    lines: dict[str, Any] = field(default_factory=dict, init=False)
+    state_runs: dict[str, StateRuns] = field(default_factory=dict, init=False)
+    state_bars: dict[str, Any] = field(default_factory=dict, init=False)
+    _state_colors: dict[str, Any] = field(default_factory=dict, init=False, repr=False)
+    decimated_lines: dict[str, DecimatedLine] = field(default_factory=dict, init=False)
+    legend_texts: dict[str, Any] = field(default_factory=dict, init=False)
+    units: dict[str, str] = field(default_factory=dict, init=False)
+    background: Any = field(default=None, init=False, repr=False)
+    _animated: list = field(default_factory=list, init=False, repr=False)
+    _auto_limits: tuple = field(default=None, init=False, repr=False)
+    _ymin: float = field(default=np.inf, init=False)
+    _ymax: float = field(default=-np.inf, init=False)
+    _last_xloc: Any = field(default=None, init=False)
+
+    def __post_init__(self):
+        self.canvas.mpl_connect("draw_event", self._on_draw)
+
+    def numeric_keys(self, columns):
+        return [key for key in columns.keys() if key not in ["time", "state", "elapsed_time"] and key not in self.state_keys]
+
+    def _setup(self, store, columns):
+        from matplotlib import colormaps
+        self.units = store.units
+        for key in self.numeric_keys(columns):
+            (self.lines[key],) = self.ax.plot([], [], label=key, animated=True)
+        cmap = colormaps["tab10"]
+        for i, key in enumerate(self.state_keys.keys()):
+            self._state_colors[key] = cmap(i)
+            self.state_runs[key] = StateRuns(list(self.state_keys[key]))
+            self.state_bars[key] = self.ax.broken_barh([], self._state_bar_yrange(i), label=key,
+                                                       color=cmap(i), animated=True)
+        self.decimated_lines = {key: DecimatedLine(line) for key, line in self.lines.items()}
+        connect_decimation(self.ax, self.decimated_lines.values())
+        self._ymin = self._state_bar_yrange(len(self.state_keys))[0]  # keep the state bars in view
+        # the empty axes still have linear limits down to 0, which a log scale can't show
+        self.ax.set_ylim(self._ymin/2, 1)
+        self.ax.set_yscale("log")
+        self.ax.grid(True, which="both", axis="both")
+        legend = self.ax.legend(loc="upper left", bbox_to_anchor=(1.05, 1), borderaxespad=0.)
+        # the legend lists lines before collections
+        labeled_keys = list(self.lines.keys())+list(self.state_bars.keys())
+        self.legend_texts = dict(zip(labeled_keys, legend.get_texts()))
+        legend.set_animated(True)
+        self.cursor_line = self.ax.axvline(0, animated=True, visible=False)
+        self.annotation = self.ax.text(1.05, 0.5, "", transform=self.ax.transAxes, fontsize=12,
+                                       verticalalignment='top', horizontalalignment='left',
+                                       family='monospace', animated=True)
+        self._animated = list(self.lines.values())+list(self.state_bars.values())+[legend, self.cursor_line, self.annotation]
+        self.ax.figure.tight_layout()
+
+    def _set_new_points(self, columns, x, n_new):
+        n_new = min(n_new, len(x))
+        if n_new == 0:
+            return
+        for key in self.numeric_keys(columns):
+            new_v = np.asarray(columns[key][-n_new:], dtype=float)
+            positive = new_v[np.isfinite(new_v) & (new_v > 0)]
+            if len(positive) > 0:
+                self._ymin = min(self._ymin, positive.min())
+                self._ymax = max(self._ymax, positive.max())
+        for i, key in enumerate(self.state_keys.keys()):
+            self.state_runs[key].extend(x[-n_new:], columns[key][-n_new:])
+            self._set_state_bars(i, key)
+        for key, decimated_line in self.decimated_lines.items():
+            decimated_line.set_data(x, columns[key])
+
+    def _state_bar_yrange(self, i):
+        # (bottom, height) of the bar for the i-th state key, symmetric on a log axis
+        yval = (2e-2)*(0.9**i)
+        return (yval/1.04, yval*1.04-yval/1.04)
+
+    def _set_state_bars(self, i, key):
+        from matplotlib.colors import to_rgba
+        intervals, codes = self.state_runs[key].intervals()
+        bottom, height = self._state_bar_yrange(i)
+        x0, x1 = intervals[:, 0], intervals[:, 0]+intervals[:, 1]
+        verts = np.stack([np.column_stack([x0, np.full_like(x0, bottom)]),
+                          np.column_stack([x0, np.full_like(x0, bottom+height)]),
+                          np.column_stack([x1, np.full_like(x0, bottom+height)]),
+                          np.column_stack([x1, np.full_like(x0, bottom)])], axis=1)
+        color = to_rgba(self._state_colors[key])
+        # first category dark, second light, then grey for unknown and anything unexpected
+        palette = np.array([color, (*color[:3], 0.35), (0.5, 0.5, 0.5, 0.35), (0.5, 0.5, 0.5, 0.8)])
+        self.state_bars[key].set_verts(verts)
+        self.state_bars[key].set_facecolor(palette[np.minimum(codes, len(palette)-1)])
+
+    def _update_labels(self, columns):
+        for key, text in self.legend_texts.items():
+            val = columns[key][-1]
+            if key in self.state_keys:
+                text.set_text(f"{key}={val}")
+            else:
+                try:
+                    text.set_text(f"{key}={val:.2f} {self.units[key]}")
+                except (TypeError, ValueError):
+                    text.set_text(f"{key}={val} {self.units[key]}")
+
+    def _update_annotation(self, columns, x, xloc_mouse):
+        if xloc_mouse is None:
+            self.cursor_line.set_visible(False)
+            self.annotation.set_text("")
+            return
+        # x is monotonic, so a bisection instead of a scan over the whole run
+        xloc_ind = min(np.searchsorted(x, xloc_mouse), len(x)-1)
+        annotation_lines = [f"elapsed_time={x[xloc_ind]} s"]
+        for key in self.numeric_keys(columns):
+            val = columns[key][xloc_ind]
+            annotation_lines.append(f"{key}={val:.3f} {self.units[key]}")
+        for key in list(self.state_keys.keys())+["state"]:
+            annotation_lines.append(f"{key}={columns[key][xloc_ind]}")
+        self.cursor_line.set_xdata([xloc_mouse, xloc_mouse])
+        self.cursor_line.set_visible(True)
+        self.annotation.set_text("\n".join(annotation_lines))
+
+    def _rescale_if_needed(self, x):
+        # returns True if the limits changed, which requires a full draw
+        # once the user has zoomed or panned, the limits are left alone
+        if self._auto_limits is not None and self._auto_limits != (self.ax.get_xlim(), self.ax.get_ylim()):
+            return False
+        xmin, xmax = self.ax.get_xlim()
+        ymin, ymax = self.ax.get_ylim()
+        needs_rescale = self._auto_limits is None or x[-1] > xmax or self._ymin < ymin or self._ymax > ymax
+        if not needs_rescale:
+            return False
+        # leave headroom so this only happens every so often
+        span = max(x[-1]-x[0], 60)
+        self.ax.set_xlim(x[0], x[-1]+0.25*span)
+        if np.isfinite(self._ymin) and np.isfinite(self._ymax):
+            self.ax.set_ylim(self._ymin/2, self._ymax*2)
+        self._auto_limits = (self.ax.get_xlim(), self.ax.get_ylim())
+        return True
+
+    def _on_draw(self, event):
+        if event is not None and event.canvas != self.canvas:
+            return
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        fig = self.canvas.figure
+        for artist in self._animated:
+            fig.draw_artist(artist)
+
+    def redraw(self, full=False):
+        if full or self.background is None:
+            self.canvas.draw()  # our draw_event handler captures the background and draws the lines
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_animated()
+        self.canvas.blit(self.canvas.figure.bbox)
+        self.canvas.flush_events()
+
+    def update(self, store, xloc_mouse):
+        if store.n_recorded == 0 or (store.n_recorded == self.n_seen and xloc_mouse == self._last_xloc):
+            return
+        n, columns = store.snapshot()
+        x = columns["time"]-store.t0
+        if self.n_seen == 0:
+            self._setup(store, columns)
+        self._set_new_points(columns, x, n-self.n_seen)
+        self._update_labels(columns)
+        self._update_annotation(columns, x, xloc_mouse)
+        self.n_seen = n
+        self._last_xloc = xloc_mouse
+        self.redraw(full=self._rescale_if_needed(x))
@@ -0,0 +1,171 @@
+import numpy as np
+from dataclasses import dataclass, field
+from typing import Any
+import threading
+
+from acquisition import result_name
+
+
+@dataclass
+class RingBuffer:
+    """A fixed capacity numpy array, once full each append overwrites the oldest value."""
+    capacity: int
+    dtype: Any = float
+    n: int = field(default=0, init=False)
+    _data: np.ndarray = field(default=None, init=False, repr=False)
+    _next: int = field(default=0, init=False, repr=False)
+
+    def __post_init__(self):
+        self._data = np.empty(self.capacity, dtype=self.dtype)
+
+    def append(self, value):
+        self._data[self._next] = value
+        self._next = (self._next+1) % self.capacity
+        self.n = min(self.n+1, self.capacity)
+
+    def extend(self, values):
+        # append many at once, only the last capacity of them if there are more
+        values = np.asarray(values, dtype=self.dtype)[-self.capacity:]
+        idx = (self._next+np.arange(len(values))) % self.capacity
+        self._data[idx] = values
+        self._next = (self._next+len(values)) % self.capacity
+        self.n = min(self.n+len(values), self.capacity)
+
+    def view(self) -> np.ndarray:
+        # a chronological copy, oldest first
+        if self.n < self.capacity:
+            return self._data[:self.n].copy()
+        return np.concatenate([self._data[self._next:], self._data[:self._next]])
+
+    def tail(self, n) -> np.ndarray:
+        n = min(n, self.n)
+        idx = (self._next-n+np.arange(n)) % self.capacity
+        return self._data[idx]
+
+    def __len__(self):
+        return self.n
+
+
+@dataclass
+class TieredRingBuffer:
+    """
+    The last full_capacity samples at full rate, plus every every_n-th sample
+    before that in a second ring of older_capacity samples.
+    """
+    full_capacity: int
+    older_capacity: int
+    every_n: int
+    dtype: Any = float
+    n_appended: int = field(default=0, init=False)
+    full: RingBuffer = field(default=None, init=False)
+    older: RingBuffer = field(default=None, init=False)
+    older_index: RingBuffer = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        self.full = RingBuffer(self.full_capacity, self.dtype)
+        self.older = RingBuffer(self.older_capacity, self.dtype)
+        self.older_index = RingBuffer(self.older_capacity, int)
+
+    def append(self, value):
+        self.full.append(value)
+        if self.n_appended % self.every_n == 0:
+            self.older.append(value)
+            self.older_index.append(self.n_appended)
+        self.n_appended += 1
+
+    def view(self) -> np.ndarray:
+        # the older tier up to where the full rate tier starts, then the full rate tier
+        first_full_index = self.n_appended-len(self.full)
+        n_older = np.searchsorted(self.older_index.view(), first_full_index)
+        return np.concatenate([self.older.view()[:n_older], self.full.view()])
+
+    def tail(self, n) -> np.ndarray:
+        return self.full.tail(n)
+
+
+@dataclass
+class LiveStore:
+    """
+    Bounded memory copy of the logged parameters for the GUI and the state logic.
+
+    Keeps the last live_window_s at the tick rate and a sample every older_every_s
+    for older_window_s before that. The SQLite database stays the full record of a
+    run, this only holds what is useful to look at live. Text parameters are stored
+    as integer category codes. A parameter missing from a recorded row repeats its
+    previous value, so all columns stay aligned with "time".
+    """
+    tick_s: float = 1
+    live_window_s: float = 6*3600
+    older_every_s: float = 60
+    older_window_s: float = 7*24*3600
+    units: dict[str, str] = field(default_factory=dict)
+    n_recorded: int = field(default=0, init=False)
+    t0: float = field(default=None, init=False)
+    _buffers: dict[str, TieredRingBuffer] = field(default_factory=dict, init=False, repr=False)
+    _categories: dict[str, list[str]] = field(default_factory=dict, init=False, repr=False)
+    _last: dict[str, Any] = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def _new_buffer(self, dtype):
+        return TieredRingBuffer(full_capacity=int(self.live_window_s/self.tick_s),
+                                older_capacity=int(self.older_window_s/self.older_every_s),
+                                every_n=max(1, round(self.older_every_s/self.tick_s)),
+                                dtype=dtype)
+
+    def _encode(self, name, value):
+        if name not in self._categories:
+            return np.nan if value is None else value
+        if value not in self._categories[name]:
+            self._categories[name].append(value)
+        return self._categories[name].index(value)
+
+    def _add_column(self, name, value, param):
+        is_text = isinstance(value, str)
+        if is_text:
+            self._categories[name] = []
+        buffer = self._new_buffer(int if is_text else float)
+        # back fill earlier rows so the new column lines up with the others
+        for i in range(self.n_recorded):
+            buffer.append(self._encode(name, "") if is_text else np.nan)
+        self._buffers[name] = buffer
+        if name not in self.units:
+            self.units[name] = getattr(param, "unit", "")
+
+    def record(self, results: list[tuple[Any, Any]]):
+        with self._lock:
+            row = {}
+            for param, value in results:
+                name = result_name(param)
+                if name not in self._buffers:
+                    self._add_column(name, value, param)
+                row[name] = value
+            for name, buffer in self._buffers.items():
+                value = row.get(name, self._last.get(name))
+                self._last[name] = value
+                buffer.append(self._encode(name, value))
+            if self.t0 is None and "time" in row:
+                self.t0 = row["time"]
+            self.n_recorded += 1
+
+    def _decode(self, name, values):
+        if name not in self._categories:
+            return values
+        return np.array(self._categories[name])[values]
+
+    def columns(self) -> dict[str, np.ndarray]:
+        """Every column, oldest first, text columns decoded back to strings."""
+        with self._lock:
+            return {name: self._decode(name, buffer.view()) for name, buffer in self._buffers.items()}
+
+    def snapshot(self) -> tuple[int, dict[str, np.ndarray]]:
+        """n_recorded and columns() read together, consistent with each other."""
+        with self._lock:
+            return self.n_recorded, {name: self._decode(name, buffer.view()) for name, buffer in self._buffers.items()}
+
+    def tail(self, name, n) -> np.ndarray:
+        """The last n full rate values of one column."""
+        with self._lock:
+            return self._decode(name, self._buffers[name].tail(n))
+
+    def is_text(self, name) -> bool:
+        return name in self._categories
@@ -1,5 +1,8 @@
 import numpy as np
 from station_2pac import get_station
+from acquisition import make_station_acquisition, LatestValues
+from log_writer import BufferedDataSaver, DeadbandFilter, STATION_DEADBANDS
+from quench_trigger import start_quench_capture
 from qcodes import (initialise_or_create_database_at,
 load_or_create_experiment,
 Measurement)
@@ -33,47 +36,40 @@ meas.register_parameter(st.cryocon.chB_temperature, setpoints=[elapsed_time])
 meas.register_parameter(st.cryocon.chC_temperature, setpoints=[elapsed_time])
 meas.register_parameter(st.cryocon.chD_temperature, setpoints=[elapsed_time])
 meas.register_parameter(st.labjack.kepco_current, setpoints=[elapsed_time])
-meas.register_parameter(st.labjack.kepco_voltage)
+meas.register_parameter(st.labjack.kepco_voltage, setpoints=[elapsed_time])
 meas.register_parameter(st.ls370.heater.out, setpoints=[elapsed_time])
-meas.register_parameter(st.labjack.relay, paramtype="text")
-meas.register_parameter(st.labjack.heatswitch_adr, paramtype="text")
-meas.register_parameter(st.labjack.heatswitch_charcoal, paramtype="text")
-meas.register_parameter(st.labjack.heatswitch_pot, paramtype="text")
+meas.register_parameter(st.labjack.relay, paramtype="text", setpoints=[elapsed_time])
+meas.register_parameter(st.labjack.heatswitch_adr, paramtype="text", setpoints=[elapsed_time])
+meas.register_parameter(st.labjack.heatswitch_charcoal, paramtype="text", setpoints=[elapsed_time])
+meas.register_parameter(st.labjack.heatswitch_pot, paramtype="text", setpoints=[elapsed_time])
 meas.register_parameter(st.labjack.he3_pressure, setpoints=[elapsed_time])
 meas.register_custom_parameter("state", paramtype="text")
 meas.register_custom_parameter("faa_temperature", unit="K", setpoints=[elapsed_time])
 meas.register_custom_parameter("time", unit="s")
 
-def retry(f,n=3):
-    # try cryocon is being unreliable on returning temp, so try a few times then return nan
-    for i in range(n):
-        try:
-            return f()
-        except: 
-            pass
-            # print(f"RETRYING {i=}")
-            # st.cryocon.write("CLR")
-            # time.sleep(0.1)
-    return np.nan
+# each instrument is read on its own worker thread, see acquisition.py
+acquisition = make_station_acquisition(st)
+# newest value of every logged parameter, written each tick by update
+latest = LatestValues()
 
 def update(datasaver, state):
     # st.cryocon.write("CLR") # try to help the cryocon work more reliably
-    parameters = [elapsed_time, st.cryocon.chA_temperature, st.cryocon.chB_temperature,
-                  st.cryocon.chC_temperature, st.cryocon.chD_temperature, st.labjack.kepco_current, st.labjack.kepco_voltage, st.ls370.heater.out,
-                  st.labjack.relay, st.labjack.heatswitch_adr, st.labjack.heatswitch_charcoal, st.labjack.heatswitch_pot, st.labjack.he3_pressure]
-    l=[(param,retry(param,n=1)) for param in parameters]+[("state", state.name()),("faa_temperature", st.ls370.ch04.temperature()), ("time", time.time())]
+    return record(datasaver, state, acquisition.acquire(state.name()))
+
+def record(datasaver, state, results):
+    # results as returned by acquisition.acquire or acquire_async
+    l=[(elapsed_time, elapsed_time())]+results
+    now = time.time()
+    l+=[("state", state.name()), ("time", now)]
     datasaver.add_result(*l)
+    latest.record(l, timestamp=now)
+    return l
 
 
 datasaver = meas.run()
 
 def most_recent_measurements():
-    data = datasaver.dataset.cache.data()
-    ret = {}
-    for key in data.keys():
-        v = data[key][key][-1]
-        ret[key]=v
-    return ret
+    return latest.snapshot()
 
 def pretty_str_dict(d: dict):
     s = ""
@@ -93,6 +89,7 @@ from dataclasses import dataclass, field
 import ipywidgets as widgets
 from IPython.display import display
 from qcodes.dataset.data_set import DataSet
+from live_plot import decimated_plot_dataset
 
 @dataclass
 class LivePlotDataset:
@@ -134,7 +131,8 @@ class LivePlotDataset:
             self.first_time()
         for ax in self.axes:
             ax.clear()
-        plot_dataset(self.dataset, self.axes)
+        # min/max decimated so long runs don't hand every sample to matplotlib
+        decimated_plot_dataset(self.dataset, self.axes)
         self.extra_ax.clear()
 
         # Example: update extra_ax with recent measurement info
@@ -148,12 +146,29 @@ class StationWorld(World):
     station: qcodes.station.Station = None
     datasaver: typing.Any = None
     liveplot: LivePlotDataset = None
+    _plot_due: bool = field(default=False, init=False, repr=False)
 
     def update(self, state):
+        # may run on the acquisition thread, so only mark the plot stale here
         update(self.datasaver, state)
-        if self.liveplot is None:
-            self.liveplot = LivePlotDataset(self.datasaver.dataset)
-        self.liveplot.plot()
+        self._plot_due = True
+
+    def _sleep(self, seconds):
+        # matplotlib stays on the runner's thread, the plot is redrawn while it would sleep anyway
+        if self._plot_due:
+            self._plot_due = False
+            if self.liveplot is None:
+                self.liveplot = LivePlotDataset(self.datasaver.dataset)
+            self.liveplot.plot()
+        super()._sleep(seconds)
+
+    def record(self, state, results):
+        record(self.datasaver, state, results)
+        self._plot_due = True
+
+    def on_state_change(self, old_state, new_state):
+        # get everything up to the transition onto disk
+        self.datasaver.flush()
 
 world = StationWorld(station=st)
 
@@ -505,9 +520,18 @@ def start_adr_cycle(world:StationWorld):
 
     world.wait_for_input('go')
 
-with meas.run() as datasaver:
-    world.datasaver = datasaver
-    world.run_state(wait_forever)
+# rows are batched into one transaction every few seconds by BufferedDataSaver, and written
+# from a background thread so a slow disk doesn't hold up the control loop. Samples that stay
+# within their deadband are not written, readers hold each value until the next sample
+with meas.run(write_in_background=True) as datasaver:
+    world.datasaver = BufferedDataSaver(datasaver, deadband=DeadbandFilter(STATION_DEADBANDS))
+    # the kepco channels stream at 2 kHz alongside the 1 Hz log, any quench is saved at full rate
+    quench_capture = start_quench_capture(st.labjack, run_id=datasaver.run_id)
+    try:
+        world.run_state(wait_forever)
+    finally:
+        if quench_capture is not None:
+            quench_capture.stop()
     # world.run_state(start_he3_cycle)
     # world.run_state(ready_for_cooldown)
     # world.run_state(ramp_tester)
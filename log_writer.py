@@ -0,0 +1,120 @@
+import math
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+from acquisition import result_name
+
+
+@dataclass
+class DeadbandFilter:
+    """
+    Drops samples that haven't moved since the last one stored.
+
+    A parameter in tolerances is stored only when it moves more than its tolerance
+    from the last stored value, or max_interval_s has passed since then. Text
+    parameters are stored when they change, whatever their tolerance. Parameters not
+    in tolerances are always stored. Readers step-hold: a value stays valid until the
+    next stored sample, so a parameter must have a setpoint, or its timing is lost.
+    The setpoints are dropped too when no dependent parameter is left in the row.
+    """
+    tolerances: dict[str, float] = field(default_factory=dict)
+    max_interval_s: float = 60
+    setpoint_names: set[str] = field(default_factory=lambda: {"elapsed_time"})
+    standalone_names: set[str] = field(default_factory=lambda: {"time", "state"})
+    _last_stored: dict[str, tuple[Any, float]] = field(default_factory=dict, init=False, repr=False)
+
+    def _moved(self, name, value, tolerance):
+        last_value = self._last_stored[name][0]
+        if not isinstance(value, (int, float)) or not isinstance(last_value, (int, float)):
+            return value != last_value  # text, or a failed read
+        if math.isnan(value) or math.isnan(last_value):
+            return not (math.isnan(value) and math.isnan(last_value))
+        return abs(value-last_value) > tolerance
+
+    def keep(self, name: str, value, now_s: float) -> bool:
+        if name not in self.tolerances:
+            return True
+        if (name not in self._last_stored or
+                now_s-self._last_stored[name][1] >= self.max_interval_s or
+                self._moved(name, value, self.tolerances[name])):
+            self._last_stored[name] = (value, now_s)
+            return True
+        return False
+
+    def filter(self, results: list[tuple[Any, Any]], now_s: float = None) -> list[tuple[Any, Any]]:
+        if now_s is None:
+            now_s = time.time()
+        kept = [(param, value) for param, value in results if self.keep(result_name(param), value, now_s)]
+        names = {result_name(param) for param, value in kept}
+        if names <= self.setpoint_names | self.standalone_names:
+            kept = [(param, value) for param, value in kept if result_name(param) not in self.setpoint_names]
+        return kept
+
+
+# absolute tolerances in each parameter's own unit, the switches and the relay are text so
+# they are stored on change
+STATION_DEADBANDS = {"cryocon_chA_temperature": 0.1,
+                     "cryocon_chB_temperature": 0.01,
+                     "cryocon_chC_temperature": 0.01,
+                     "cryocon_chD_temperature": 0.001,
+                     "faa_temperature": 0.0005,
+                     "labjack_kepco_current": 0.001,
+                     "labjack_kepco_voltage": 0.001,
+                     "labjack_he3_pressure": 0.001,
+                     "ls370_heater_out": 0.01,
+                     "labjack_relay": 0,
+                     "labjack_heatswitch_adr": 0,
+                     "labjack_heatswitch_charcoal": 0,
+                     "labjack_heatswitch_pot": 0}
+
+
+@dataclass
+class BufferedDataSaver:
+    """
+    Wraps a qcodes DataSaver so rows are written to the database in batches.
+
+    qcodes already holds rows from add_result in memory until it flushes them, and
+    writes everything pending in one transaction. This takes control of when that
+    happens: every flush_every_s seconds or every flush_every_rows rows, whichever
+    comes first, plus whenever flush() is called, e.g. on a state transition. Leaving
+    the meas.run() context flushes whatever is left, so nothing is lost on exit.
+    Use meas.run(write_in_background=True) so a slow disk doesn't hold up add_result.
+    With a deadband, each row is passed through it first, see DeadbandFilter.
+    add_result and flush may be called from different threads, e.g. the background
+    acquisition thread and the state runner, they take turns on one lock.
+    """
+    datasaver: Any
+    deadband: DeadbandFilter = None
+    flush_every_s: float = 10
+    flush_every_rows: int = 60
+    rows_since_flush: int = field(default=0, init=False)
+    last_flush_time_s: float = field(default_factory=time.monotonic, init=False)
+    _lock: threading.RLock = field(default_factory=threading.RLock, init=False, repr=False)
+
+    def __post_init__(self):
+        # stop qcodes from flushing on its own timer, we decide when
+        self.datasaver.write_period = float("inf")
+
+    @property
+    def dataset(self):
+        return self.datasaver.dataset
+
+    def add_result(self, *results):
+        with self._lock:
+            if self.deadband is not None:
+                results = self.deadband.filter(list(results))
+                if not results:
+                    return
+            self.datasaver.add_result(*results)
+            self.rows_since_flush += 1
+            if (self.rows_since_flush >= self.flush_every_rows or
+                    time.monotonic()-self.last_flush_time_s >= self.flush_every_s):
+                self.flush()
+
+    def flush(self, block=False):
+        with self._lock:
+            self.datasaver.flush_data_to_database(block=block)
+            self.rows_since_flush = 0
+            self.last_flush_time_s = time.monotonic()
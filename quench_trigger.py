@@ -0,0 +1,198 @@
+import csv
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+from labjack_stream import StreamCapture, STREAM_DIR
+
+# watches the labjack stream for quenches and keeps the full rate samples around each one,
+# named by qcodes run_id so read_logs.plot_triggers(run_id) finds them
+#
+#     capture = start_quench_capture(st.labjack, run_id=datasaver.run_id)
+#     ...
+#     capture.stop()
+
+TRIGGER_DIR = STREAM_DIR / "triggers"
+TRIGGER_INDEX_COLUMNS = ["run_id", "time", "rule", "channel", "value", "path"]
+
+
+@dataclass
+class TriggerRule:
+    """
+    kind "slope" fires when the channel changes faster than threshold per second,
+    kind "level" when its magnitude goes above threshold. The signal is first
+    averaged over smooth_s, a slope is taken across slope_window_s.
+    """
+    name: str
+    channel: str
+    kind: str
+    threshold: float
+    smooth_s: float = 0.02
+    slope_window_s: float = 0.1
+
+    def lookback_s(self) -> float:
+        # how much already checked signal is needed to evaluate the newest sample
+        return self.smooth_s+(self.slope_window_s if self.kind == "slope" else 0)
+
+    def first_crossing(self, values, scan_frequency_hz, from_index=0) -> tuple[int, float]:
+        # (index into values, the value that crossed) of the first crossing at or after from_index, or (None, None)
+        n_smooth = max(int(self.smooth_s*scan_frequency_hz), 1)
+        if len(values) < n_smooth:
+            return None, None
+        values = np.asarray(values, dtype=float)
+        missing = np.isnan(values)  # the stream pads missed scans with nan
+        cumsum = np.cumsum(np.insert(np.where(missing, 0, values), 0, 0))
+        n_missing = np.cumsum(np.insert(missing, 0, False))
+        smoothed = (cumsum[n_smooth:]-cumsum[:-n_smooth])/n_smooth  # smoothed[i] ends at values[i+n_smooth-1]
+        # a window with a missed scan in it is nan, nan never crosses a threshold, so a usb hiccup isn't a quench
+        smoothed[n_missing[n_smooth:]-n_missing[:-n_smooth] > 0] = np.nan
+        offset = n_smooth-1
+        if self.kind == "slope":
+            n_slope = max(int(self.slope_window_s*scan_frequency_hz), 1)
+            if len(smoothed) <= n_slope:
+                return None, None
+            signal = (smoothed[n_slope:]-smoothed[:-n_slope])*scan_frequency_hz/n_slope
+            offset += n_slope
+        elif self.kind == "level":
+            signal = smoothed
+        else:
+            raise ValueError(self.kind)
+        crossed = np.flatnonzero(np.abs(signal) > self.threshold)
+        crossed = crossed[crossed+offset >= from_index]
+        if len(crossed) == 0:
+            return None, None
+        return crossed[0]+offset, float(signal[crossed[0]])
+
+
+# the ramps move the magnet current by about 0.01 A/s and stay well inside the supply's 20 V,
+# a quench is much faster than that and drives the supply towards its voltage limit
+STATION_TRIGGERS = [TriggerRule("current_slope", "kepco_current", "slope", threshold=0.2),
+                    TriggerRule("voltage_level", "kepco_voltage", "level", threshold=15)]
+
+
+@dataclass
+class TriggerEngine:
+    """
+    Checks the new stream samples against the rules every check_every_s, on its own
+    thread. When a rule fires, the samples from pre_s before to post_s after it are
+    saved by the stream and listed in triggers.csv with the run_id. The rules then
+    rest for holdoff_s, so one quench makes one file.
+    """
+    stream: StreamCapture
+    rules: list[TriggerRule] = field(default_factory=lambda: list(STATION_TRIGGERS))
+    run_id: int = None
+    pre_s: float = 10
+    post_s: float = 20
+    holdoff_s: float = 60
+    check_every_s: float = 0.1
+    out_dir: Path = TRIGGER_DIR
+    events: list[dict] = field(default_factory=list, init=False)
+    _checked_index: int = field(default=0, init=False, repr=False)
+    _holdoff_until_index: int = field(default=0, init=False, repr=False)
+    _stop: threading.Event = field(default_factory=threading.Event, init=False, repr=False)
+    _thread: threading.Thread = field(default=None, init=False, repr=False)
+
+    def start(self):
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="quench_trigger", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.check_every_s):
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+
+    def check(self):
+        stream = self.stream
+        n_samples = stream.n_samples
+        if n_samples <= self._checked_index:
+            return
+        for rule in self.rules:
+            lookback = int(rule.lookback_s()*stream.scan_frequency_hz)
+            first_new_index = max(self._checked_index, self._holdoff_until_index)
+            times, values = stream.window(max(first_new_index-lookback, 0), n_samples)
+            if len(times) == 0:
+                continue
+            from_index = first_new_index-stream.sample_index(times[0])
+            i, value = rule.first_crossing(values[rule.channel], stream.scan_frequency_hz, from_index)
+            if i is None:
+                continue
+            self._fire(rule, times[i], value)
+            break
+        self._checked_index = n_samples
+
+    def _fire(self, rule, time_s, value):
+        print(f"trigger {rule.name}: {rule.channel}={value:.4g} at {time.ctime(time_s)}")
+        self._holdoff_until_index = self.stream.sample_index(time_s+self.holdoff_s)
+        event = {"run_id": self.run_id, "time": time_s, "rule": rule.name, "channel": rule.channel,
+                 "value": value, "path": None}
+        self.events.append(event)
+        label = f"run{self.run_id if self.run_id is not None else 0:05}_{rule.name}"
+
+        def on_saved(path):
+            # the saved window goes into the run's trigger directory, then into the index
+            run_path = self.out_dir / path.name
+            path.replace(run_path)
+            event["path"] = str(run_path)
+            self._append_to_index(event)
+
+        self.stream.snapshot(time_s, self.pre_s, self.post_s, label=label, on_saved=on_saved)
+
+    def _append_to_index(self, event):
+        index_path = self.out_dir / "triggers.csv"
+        new_file = not index_path.exists()
+        with open(index_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=TRIGGER_INDEX_COLUMNS)
+            if new_file:
+                writer.writeheader()
+            writer.writerow(event)
+
+
+def load_trigger_index(run_id=None, out_dir=TRIGGER_DIR) -> list[dict]:
+    # the triggers.csv rows, only those of run_id if given
+    index_path = Path(out_dir) / "triggers.csv"
+    if not index_path.exists():
+        return []
+    with open(index_path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    return [row for row in rows if run_id is None or row["run_id"] == str(run_id)]
+
+
+@dataclass
+class QuenchCapture:
+    labjack: object
+    engine: TriggerEngine
+
+    def stop(self):
+        self.engine.stop()
+        self.labjack.stop_stream()
+
+
+def start_quench_capture(labjack, run_id=None, scan_frequency_hz=2000, **engine_kwargs) -> Union[QuenchCapture, None]:
+    """
+    Start the labjack streaming and a TriggerEngine on it, stop both with .stop().
+    None if the stream can't be started, the labjack then stays on feedback reads so
+    the run is logged as usual, just without quench capture.
+    """
+    try:
+        stream = labjack.start_stream(scan_frequency_hz=scan_frequency_hz)
+    except Exception:
+        print("labjack stream failed to start, logging without quench capture")
+        traceback.print_exc()
+        return None
+    engine = TriggerEngine(stream, run_id=run_id, **engine_kwargs)
+    engine.start()
+    return QuenchCapture(labjack, engine)
@@ -2,7 +2,10 @@ import os
 path = '/home/pcuser/.2pac_logs'
 os.chdir(path)
 
+import numpy as np
 import qcodes as qc
+from run_cache import load_run
+from quench_trigger import load_trigger_index
 
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -44,15 +47,42 @@ def plot_data(run_id):
     fig2, axes2 = plt.subplots(2,2, figsize = (10,10), sharex= True)
     axes_list = [axes1[0][0], axes1[0][1], axes1[1][0], axes1[1][1],
                                             axes2[0][0], axes2[0][1], axes2[1][0], axes2[1][1]]
-    qc.dataset.plot_by_id(run_id = run_id, axes= axes_list)
-    dataset = qc.load_by_id(run_id=run_id)
-    
+    # the run is read from the database once, then from the columnar cache in run_cache
+    run = load_run(run_id)
+
     for i, ax in enumerate(axes_list):
+        if params[i] not in run.columns:  # older runs didn't log everything
+            continue
+        x, y = run.xy(params[i])
+        # deadbanded samples hold until the next one, the last one until the end of the run
+        if len(y) > 0:
+            x, y = np.r_[x, run.x_end(params[i])], np.r_[y, y[-1]]
+        ax.plot(x, y, drawstyle="steps-post")
+        ax.set(xlabel = f'{run.setpoints[params[i]][0]} ({run.units[run.setpoints[params[i]][0]]})')
         ax.set( ylabel = ylabels[i], title = names[i])
         # ax.grid(ls = ':', alpha = 0.75)
 
-    fig1.suptitle (f'Experiment in 2pac ADR: Run {run_id} {dataset.completed_timestamp()=}')
-    fig2.suptitle (f'Experiment in 2pac ADR: Run {run_id} {dataset.completed_timestamp()=}')
+    fig1.suptitle (f'Experiment in 2pac ADR: Run {run_id} {run.completed_timestamp=}')
+    fig2.suptitle (f'Experiment in 2pac ADR: Run {run_id} {run.completed_timestamp=}')
+    plt.tight_layout()
+    plt.show()
+
+
+def plot_triggers(run_id):
+    # the full rate kepco samples saved around each quench trigger of the run, see quench_trigger.py
+    triggers = [t for t in load_trigger_index(run_id) if t["path"]]
+    if not triggers:
+        print(f"no triggers saved for run {run_id}")
+        return
+    fig, axes = plt.subplots(len(triggers), 2, figsize=(12, 4*len(triggers)), squeeze=False)
+    for (ax_current, ax_voltage), trigger in zip(axes, triggers):
+        snapshot = np.load(trigger["path"])
+        t = snapshot["time"]-float(snapshot["trigger_time"])
+        ax_current.plot(t, snapshot["kepco_current"])
+        ax_current.set(xlabel="time from trigger (s)", ylabel="Current (A)", title=f"{trigger['rule']} {trigger['value']}")
+        ax_voltage.plot(t, snapshot["kepco_voltage"])
+        ax_voltage.set(xlabel="time from trigger (s)", ylabel="Voltage (V)")
+    fig.suptitle(f"Quench triggers in run {run_id}")
     plt.tight_layout()
     plt.show()
 
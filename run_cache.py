@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+import qcodes as qc
+
+# one directory per database, in it one directory per completed run, one .npy file per parameter
+# so a column can be memory mapped on its own, plus meta.json with the database, setpoints, units
+# and completed timestamp. The setpoints of parameter p are stored as p.setpoint, since parameters
+# can be sampled at different rates
+CACHE_DIR = Path.home() / ".2pac_logs" / "run_cache"
+
+
+@dataclass
+class RunData:
+    run_id: int
+    columns: dict[str, np.ndarray]
+    setpoints: dict[str, list[str]] = field(default_factory=dict)
+    units: dict[str, str] = field(default_factory=dict)
+    completed_timestamp: str = None
+
+    def setpoint_values(self, param, setpoint):
+        # each parameter keeps its own copy of its setpoints, parameters sampled less often
+        # than every tick have fewer rows. Caches written before that hold one shared copy.
+        return self.columns.get(f"{param}.{setpoint}", self.columns.get(setpoint))
+
+    def xy(self, param):
+        # the parameter against its first setpoint, like plot_by_id draws it
+        return self.setpoint_values(param, self.setpoints[param][0]), self.columns[param]
+
+    def x_end(self, param) -> float:
+        """
+        The end of the run on param's x axis. Deadbanded samples hold until the next
+        one, so the last sample holds until here rather than ending where it was taken.
+        Every row has a time, and param's first sample is in the first row, so the end
+        is its first x plus the time the whole run took.
+        """
+        x = np.asarray(self.xy(param)[0], dtype=float)
+        if len(x) == 0:
+            return np.nan
+        if "time" not in self.columns or len(self.columns["time"]) == 0:
+            return float(x[-1])
+        t = np.asarray(self.columns["time"], dtype=float)
+        return max(float(x[-1]), float(x[0]+t[-1]-t[0]))
+
+
+def _db_path() -> str:
+    # the database qc.load_by_id reads from
+    return os.path.abspath(os.path.expanduser(str(qc.config["core"]["db_location"])))
+
+
+def _db_cache_dir(db_path, cache_dir) -> Path:
+    # run ids are only unique within a database, so each database gets its own directory
+    digest = hashlib.sha1(db_path.encode()).hexdigest()[:12]
+    return Path(cache_dir) / f"{Path(db_path).stem}_{digest}"
+
+
+def _run_dirs(run_id, db_cache_dir):
+    return sorted(Path(db_cache_dir).glob(f"run_{run_id:05}_*"))
+
+
+def _read_meta(run_dir) -> dict:
+    return json.loads((run_dir / "meta.json").read_text())
+
+
+def _read_run_dir(run_id, run_dir) -> RunData:
+    meta = _read_meta(run_dir)
+    columns = {name: np.load(run_dir / f"{name}.npy", mmap_mode="r") for name in meta["columns"]}
+    return RunData(run_id, columns, meta["setpoints"], meta["units"], meta["completed_timestamp"])
+
+
+def extract_run(dataset) -> RunData:
+    """Read every parameter of a dataset from the database, once."""
+    param_data = dataset.get_parameter_data()
+    columns, setpoints = {}, {}
+    for name, data in param_data.items():
+        setpoints[name] = [k for k in data.keys() if k != name]
+        for column_name, values in data.items():
+            values = np.asarray(values)
+            if values.dtype.kind not in "biuf":
+                values = values.astype(str)  # text columns as fixed width unicode, so no pickle needed
+            columns[column_name if column_name == name else f"{name}.{column_name}"] = values
+    names = set(setpoints.keys()) | {sp for sps in setpoints.values() for sp in sps}
+    units = {param_spec.name: param_spec.unit for param_spec in dataset.get_parameters()
+             if param_spec.name in names}
+    return RunData(dataset.run_id, columns, setpoints, units, dataset.completed_timestamp())
+
+
+def write_run(run: RunData, completed_timestamp_raw, db_path, cache_dir=CACHE_DIR):
+    run_dir = _db_cache_dir(db_path, cache_dir) / f"run_{run.run_id:05}_{completed_timestamp_raw:.0f}"
+    # write to a temporary directory then rename, so a half written cache is never read
+    tmp_dir = run_dir.with_name(run_dir.name + ".tmp")
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    for name, values in run.columns.items():
+        np.save(tmp_dir / f"{name}.npy", values)
+    meta = {"db_path": db_path, "columns": list(run.columns.keys()), "setpoints": run.setpoints,
+            "units": run.units, "completed_timestamp": run.completed_timestamp}
+    (tmp_dir / "meta.json").write_text(json.dumps(meta))
+    os.replace(tmp_dir, run_dir)
+
+
+def load_run(run_id, cache_dir=CACHE_DIR) -> RunData:
+    """
+    Load all parameters of a run, from the columnar cache if it has been loaded before.
+
+    A completed run never changes, so once cached it is read without opening the
+    database. Runs still in progress are read from the database every time. Runs are
+    read from qcodes' configured db_location, and only taken from the cache if they
+    were cached from that same database.
+    """
+    db_path = _db_path()
+    run_dirs = [d for d in _run_dirs(run_id, _db_cache_dir(db_path, cache_dir))
+                if not d.name.endswith(".tmp") and _read_meta(d).get("db_path") == db_path]
+    if run_dirs:
+        return _read_run_dir(run_id, run_dirs[-1])
+    dataset = qc.load_by_id(run_id)
+    run = extract_run(dataset)
+    if dataset.completed_timestamp_raw is not None:
+        write_run(run, dataset.completed_timestamp_raw, db_path, cache_dir)
+    return run
@@ -0,0 +1,122 @@
+import heapq
+import itertools
+import math
+import select
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Any, Callable, Union
+
+
+@dataclass
+class DeadlineScheduler:
+    """
+    A priority queue of named deadlines, e.g. "tick" and "wait".
+
+    Each name has at most one pending deadline, scheduling it again replaces the old
+    one. Replaced and cancelled entries stay in the heap and are skipped when they
+    reach the top, so schedule and cancel are O(log n) and O(1).
+    """
+    _heap: list = field(default_factory=list, init=False, repr=False)
+    _pending: dict[str, tuple[float, int]] = field(default_factory=dict, init=False, repr=False)
+    _counter: itertools.count = field(default_factory=itertools.count, init=False, repr=False)
+    # while watching stdin the sleep is cut into slices this long, so a gui sleep like plt.pause keeps running
+    stdin_poll_s: float = 0.1
+    # set once stdin reads '', a closed stdin is always "ready" and would make select return at once
+    stdin_closed: bool = False
+
+    def schedule(self, name: str, time_s: float):
+        entry_id = next(self._counter)
+        self._pending[name] = (time_s, entry_id)
+        heapq.heappush(self._heap, (time_s, entry_id, name))
+
+    def cancel(self, name: str):
+        self._pending.pop(name, None)
+
+    def _drop_stale(self):
+        while self._heap and self._pending.get(self._heap[0][2], (None, None))[1] != self._heap[0][1]:
+            heapq.heappop(self._heap)
+
+    def next_deadline(self) -> Union[tuple[float, str], None]:
+        # (time_s, name) of the earliest pending deadline
+        self._drop_stale()
+        if not self._heap:
+            return None
+        time_s, entry_id, name = self._heap[0]
+        return time_s, name
+
+    def deadline(self, name: str) -> Union[float, None]:
+        if name not in self._pending:
+            return None
+        return self._pending[name][0]
+
+    def pop_next_due(self, now_s: float) -> Union[str, None]:
+        # the name of the earliest deadline if it is at or before now_s, removing it
+        next_deadline = self.next_deadline()
+        if next_deadline is None or next_deadline[0] > now_s:
+            return None
+        time_s, entry_id, name = heapq.heappop(self._heap)
+        del self._pending[name]
+        return name
+
+    def sleep_until_next(self, now_s: float, sleep: Callable[[float], None], watch_stdin=False):
+        """
+        Block until the next deadline, or until a line is ready on stdin if watch_stdin,
+        whichever comes first. Never busy loops. While watching stdin this returns after
+        at most stdin_poll_s, the caller checks its input and calls again.
+        """
+        next_deadline = self.next_deadline()
+        timeout_s = None if next_deadline is None else max(0, next_deadline[0]-now_s)
+        if watch_stdin:
+            if not self.stdin_closed and sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
+                return
+            sleep(self.stdin_poll_s if timeout_s is None else min(timeout_s, self.stdin_poll_s))
+        elif timeout_s is not None:
+            sleep(timeout_s)
+
+
+@dataclass
+class TickThread:
+    """
+    Calls tick() on its own thread on a fixed grid of period_s, skipping missed ticks
+    instead of bunching up, until stop().
+
+    A tick that raises is printed and counted in n_failed, and the next tick runs as
+    usual, so one instrument timeout doesn't end logging for the rest of the run.
+    """
+    tick: Callable[[], None]
+    period_s: float
+    clock: Any = time  # anything with a time(), e.g. a World's fake time
+    name: str = "tick"
+    n_failed: int = field(default=0, init=False)
+    _thread: threading.Thread = field(default=None, init=False, repr=False)
+    _stop: threading.Event = field(default_factory=threading.Event, init=False, repr=False)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        next_tick_s = math.ceil(self.clock.time())
+        while not self._stop.wait(max(0, next_tick_s-self.clock.time())):
+            try:
+                self.tick()
+            except Exception:
+                self.n_failed += 1
+                print(f"{self.name} failed at {time.ctime()}, {self.n_failed} failures so far")
+                traceback.print_exc()
+            while next_tick_s <= self.clock.time():
+                next_tick_s += self.period_s
@@ -0,0 +1,176 @@
+import argparse
+import ast
+import json
+from dataclasses import dataclass, field
+from typing import Iterable, Union
+
+from imperative_statemachine import State, collect_exit_targets, remove_decorators
+
+# the transitions between @state functions, worked out from their return statements without
+# running them. Edges come from State.exit_targets, which the decorator already computed (and
+# cached with the compiled code), so building a graph at runtime parses nothing.
+#
+#     graph = module_state_graph(globals())
+#     print(graph.report([wait_forever, full_cycle_one_state]))
+
+
+@dataclass
+class StateGraph:
+    """
+    edges maps each state name to the names of the states it can return, None where
+    the state machine stops. dangling holds the exits that don't name a known state,
+    a typo or an expression that can't be resolved statically. states holds the State
+    objects when the graph was built from them, it is empty for a graph parsed from a
+    file with from_source.
+    """
+    edges: dict[str, list[Union[str, None]]]
+    dangling: dict[str, list[str]] = field(default_factory=dict)
+    states: dict[str, State] = field(default_factory=dict)
+
+    def successors(self, name: str) -> list[str]:
+        return [target for target in self.edges.get(name, []) if target is not None]
+
+    def reachable_from(self, starts: Iterable[Union[str, State]]) -> set[str]:
+        to_visit = [_name(start) for start in starts]
+        reachable = set()
+        while to_visit:
+            name = to_visit.pop()
+            if name in reachable:
+                continue
+            reachable.add(name)
+            to_visit.extend(self.successors(name))
+        return reachable
+
+    def unreachable(self, starts: Iterable[Union[str, State]]) -> list[str]:
+        # states that no path from any of starts leads to
+        reachable = self.reachable_from(starts)
+        return [name for name in self.edges if name not in reachable]
+
+    def terminal(self) -> list[str]:
+        # states that can stop the state machine
+        return [name for name, targets in self.edges.items() if None in targets]
+
+    def report(self, starts: Iterable[Union[str, State]]) -> str:
+        starts = [_name(start) for start in starts]
+        lines = [f"{len(self.edges)} states, starting from {', '.join(starts)}"]
+        for name in self.unreachable(starts):
+            lines.append(f"unreachable: {name}")
+        for name, exits in self.dangling.items():
+            for exit in exits:
+                lines.append(f"dangling exit: {name} -> {exit}")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {"edges": self.edges, "dangling": self.dangling, "terminal": self.terminal()}
+
+    def to_dot(self) -> str:
+        # for graphviz, dot -Tpng states.dot -o states.png
+        lines = ["digraph states {"]
+        for name, targets in self.edges.items():
+            lines.append(f'    "{name}";')
+            for target in targets:
+                if target is not None:
+                    lines.append(f'    "{name}" -> "{target}";')
+        for name, exits in self.dangling.items():
+            for exit in exits:
+                lines.append(f'    "{name}" -> "{exit}" [style=dashed, color=red];')
+        lines.append("}")
+        return "\n".join(lines)
+
+    @classmethod
+    def from_states(cls, states: Iterable[State], namespace: dict = None) -> "StateGraph":
+        """
+        Resolve each state's exit_targets to states. A name is looked up in namespace
+        if given, so a state bound under another name still resolves, otherwise it
+        must match the name of one of states.
+        """
+        states = {state.name(): state for state in states}
+        edges, dangling = {}, {}
+        for name, state in states.items():
+            edges[name] = []
+            for target in state.exit_targets:
+                resolved = _resolve(target, states, namespace)
+                if resolved is _UNRESOLVED:
+                    dangling.setdefault(name, []).append(target)
+                elif resolved not in edges[name]:
+                    edges[name].append(resolved)
+        return cls(edges, dangling, states)
+
+    @classmethod
+    def from_source(cls, source: str) -> "StateGraph":
+        # every @state function defined at the top level of a module's source, without importing it
+        lines = source.splitlines()
+        functions = {}
+        for node in ast.parse(source).body:
+            if isinstance(node, ast.FunctionDef) and any(_is_state_decorator(d) for d in node.decorator_list):
+                first_line = min([node.lineno]+[d.lineno for d in node.decorator_list])
+                functions[node.name] = remove_decorators("\n".join(lines[first_line-1:node.end_lineno]))
+        edges, dangling = {}, {}
+        for name, function_source in functions.items():
+            edges[name] = []
+            for target in collect_exit_targets(function_source):
+                if target is not None and target not in functions:
+                    dangling.setdefault(name, []).append(target)
+                elif target not in edges[name]:
+                    edges[name].append(target)
+        return cls(edges, dangling)
+
+
+_UNRESOLVED = object()
+
+
+def _name(state: Union[str, State]) -> str:
+    return state if isinstance(state, str) else state.name()
+
+
+def _resolve(target, states, namespace):
+    if target is None:
+        return None
+    if namespace is not None:
+        value = namespace.get(target)
+        return value.name() if isinstance(value, State) else _UNRESOLVED
+    return target if target in states else _UNRESOLVED
+
+
+def _is_state_decorator(decorator):
+    return (isinstance(decorator, ast.Name) and decorator.id == "state" or
+            isinstance(decorator, ast.Attribute) and decorator.attr == "state")
+
+
+_module_graphs: dict[str, StateGraph] = {}
+
+
+def module_state_graph(namespace: dict) -> StateGraph:
+    """
+    The graph of every State in a module's globals, built on the first call and
+    reused after that, e.g. module_state_graph(globals()).
+    """
+    module_name = namespace.get("__name__")
+    if module_name not in _module_graphs:
+        states = [value for value in list(namespace.values()) if isinstance(value, State)]
+        _module_graphs[module_name] = StateGraph.from_states(states, namespace)
+    return _module_graphs[module_name]
+
+
+def main():
+    # checks a module's states without importing it, so without connecting to the instruments
+    parser = argparse.ArgumentParser(description="check the @state transitions in a module")
+    parser.add_argument("path", help="python file defining the states, e.g. log_data.py")
+    parser.add_argument("--start", nargs="+", default=[], help="entry states, unreachable is reported relative to these")
+    parser.add_argument("--dot", help="write the graph to this graphviz file")
+    parser.add_argument("--json", help="write the graph to this json file")
+    args = parser.parse_args()
+
+    with open(args.path) as f:
+        graph = StateGraph.from_source(f.read())
+    print(graph.report(args.start))
+    if args.dot:
+        with open(args.dot, "w") as f:
+            f.write(graph.to_dot())
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(graph.to_dict(), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
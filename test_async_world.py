@@ -0,0 +1,53 @@
+import asyncio
+from dataclasses import dataclass
+
+import pytest
+
+from async_world import AsyncWorldRunner
+from imperative_statemachine import state
+from world_no_mpl import World
+
+
+@state
+def wait_forever(world):
+    while True:
+        world.wait(0.01)
+
+
+@state
+def wait_a_little(world):
+    for i in range(20):
+        world.wait(0.001)
+    return None
+
+
+class InstrumentError(Exception):
+    pass
+
+
+@dataclass
+class FailingWorld(World):
+    # update raises on its fail_on_update-th call, like an instrument timing out mid run
+    fail_on_update: int = 1
+    n_updates: int = 0
+
+    def update(self, state):
+        self.n_updates += 1
+        if self.n_updates >= self.fail_on_update:
+            raise InstrumentError("VISA timeout")
+
+
+def test_failed_tick_stops_the_run():
+    world = FailingWorld(target_tick_rate_s=0.05, fail_on_update=3)
+    runner = AsyncWorldRunner(world, wait_forever)
+    with pytest.raises(InstrumentError):
+        asyncio.run(asyncio.wait_for(runner.run(), timeout=5))
+    assert world.n_updates == 3
+
+
+def test_runs_on_successive_event_loops_without_piling_up_deadlines():
+    world = World(target_tick_rate_s=0.05)
+    for i in range(2):
+        asyncio.run(asyncio.wait_for(AsyncWorldRunner(world, wait_a_little).run(), timeout=5))
+    # the waits were popped as they came due, at most the next tick is left
+    assert len(world.scheduler._heap) <= 1
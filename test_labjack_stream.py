@@ -0,0 +1,29 @@
+import numpy as np
+
+from labjack_stream import StreamCapture
+
+
+def make_capture():
+    capture = StreamCapture(lj=None, channels={"kepco_current": (2, 1)}, scan_frequency_hz=100, buffer_s=10)
+    capture.start_time_s = 0
+    return capture
+
+
+def test_means_since_averages_the_new_samples():
+    capture = make_capture()
+    capture._extend({"kepco_current": np.array([1.0, 2.0, 3.0])})
+    means, next_index = capture.means_since(0)
+    assert means["kepco_current"] == 2.0
+    capture._extend({"kepco_current": np.array([np.nan, 5.0, 7.0])})
+    means, next_index = capture.means_since(next_index)
+    # the missed sample is left out
+    assert means["kepco_current"] == 6.0
+    assert next_index == 6
+
+
+def test_means_since_without_new_samples_uses_the_newest():
+    capture = make_capture()
+    capture._extend({"kepco_current": np.array([1.0, 4.0])})
+    means, next_index = capture.means_since(2)
+    assert means["kepco_current"] == 4.0
+    assert next_index == 2
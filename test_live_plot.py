@@ -0,0 +1,48 @@
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from live_plot import IncrementalLivePlot, STATE_KEYS
+from live_store import LiveStore
+
+
+def make_plot():
+    figure = Figure()
+    canvas = FigureCanvasAgg(figure)
+    return IncrementalLivePlot(figure.add_subplot(), canvas)
+
+
+def test_builds_on_a_real_canvas_and_draws():
+    plot = make_plot()
+    hash(plot)
+    plot.canvas.draw()
+    # the draw_event handler ran and cached the background for blitting
+    assert plot.background is not None
+
+
+def record_rows(store, n, t0=1000.0):
+    for i in range(n):
+        row = [("time", t0+i), ("elapsed_time", float(i)), ("faa_temperature", 0.1+0.01*i), ("state", "wait_forever")]
+        row += [(key, categories[i % 2]) for key, categories in STATE_KEYS.items()]
+        store.record(row)
+
+
+def test_setup_then_draw():
+    plot = make_plot()
+    store = LiveStore(units={"faa_temperature": "K", "time": "s"})
+    plot._setup(store, {"time": np.empty(0), "faa_temperature": np.empty(0)})
+    plot.canvas.draw()
+    assert plot.ax.get_yscale() == "log"
+    assert plot.ax.get_ylim()[0] > 0
+
+
+def test_update_draws_lines_and_state_bars():
+    plot = make_plot()
+    store = LiveStore(units={"faa_temperature": "K", "time": "s"})
+    record_rows(store, 10)
+    plot.update(store, xloc_mouse=None)
+    record_rows(store, 5, t0=1010.0)
+    plot.update(store, xloc_mouse=3.0)
+    assert plot.n_seen == 15
+    assert len(plot.lines["faa_temperature"].get_xdata()) > 0
+    assert len(plot.state_bars["labjack_relay"].get_paths()) > 0
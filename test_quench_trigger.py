@@ -0,0 +1,42 @@
+import numpy as np
+
+from quench_trigger import STATION_TRIGGERS, start_quench_capture
+
+SCAN_FREQUENCY_HZ = 2000
+current_slope = next(rule for rule in STATION_TRIGGERS if rule.name == "current_slope")
+
+
+def ramp(duration_s=30, start_A=5, rate_A_per_s=0.01):
+    t = np.arange(int(duration_s*SCAN_FREQUENCY_HZ))/SCAN_FREQUENCY_HZ
+    return start_A+rate_A_per_s*t
+
+
+def test_ramp_does_not_trigger():
+    assert current_slope.first_crossing(ramp(), SCAN_FREQUENCY_HZ) == (None, None)
+
+
+def test_missed_scans_during_ramp_do_not_trigger():
+    # the stream pads a usb hiccup with nan, it must not look like the current dropping to 0 A
+    values = ramp()
+    values[len(values)//2:len(values)//2+500] = np.nan
+    assert current_slope.first_crossing(values, SCAN_FREQUENCY_HZ) == (None, None)
+
+
+def test_quench_after_missed_scans_triggers():
+    values = ramp()
+    gap_start = len(values)//2
+    values[gap_start:gap_start+500] = np.nan
+    quench_start = gap_start+2000
+    values[quench_start:] -= 5*np.arange(len(values)-quench_start)/SCAN_FREQUENCY_HZ
+    i, value = current_slope.first_crossing(values, SCAN_FREQUENCY_HZ)
+    assert quench_start <= i < quench_start+int(current_slope.lookback_s()*SCAN_FREQUENCY_HZ)
+    assert value < -current_slope.threshold
+
+
+class LabjackWithoutStream:
+    def start_stream(self, scan_frequency_hz):
+        raise RuntimeError("streamConfig failed")
+
+
+def test_capture_is_skipped_when_the_stream_fails_to_start():
+    assert start_quench_capture(LabjackWithoutStream()) is None
@@ -0,0 +1,82 @@
+from imperative_statemachine import collect_exit_targets
+from state_graph import StateGraph
+
+SOURCE = """
+@state
+def soak(world):
+    world.wait(60)
+
+@state
+def ramp_up(world):
+    world.wait(1)
+    return soak
+
+@state
+def wait_forever(world):
+    while True:
+        world.wait(1)
+
+@state
+def check(world):
+    if world.cold():
+        return ramp_up
+    else:
+        return wait_forever
+
+@state
+def maybe_ramp(world):
+    if world.cold():
+        return ramp_up
+
+@state
+def until_cold(world):
+    while True:
+        if world.cold():
+            break
+        world.wait(1)
+"""
+
+
+def exit_targets(function_source):
+    return collect_exit_targets(function_source.strip())
+
+
+def test_falling_off_the_end_stops_the_machine():
+    graph = StateGraph.from_source(SOURCE)
+    assert graph.edges["soak"] == [None]
+    assert "soak" in graph.terminal()
+
+
+def test_exits_that_cannot_fall_through():
+    graph = StateGraph.from_source(SOURCE)
+    assert graph.edges["ramp_up"] == ["soak"]
+    assert graph.edges["wait_forever"] == []
+    assert graph.edges["check"] == ["ramp_up", "wait_forever"]
+
+
+def test_exits_that_can_fall_through():
+    graph = StateGraph.from_source(SOURCE)
+    assert graph.edges["maybe_ramp"] == ["ramp_up", None]
+    assert graph.edges["until_cold"] == [None]
+
+
+def test_try_and_with():
+    assert exit_targets("""
+def f(world):
+    try:
+        return a
+    except ValueError:
+        return b
+""") == ["a", "b"]
+    assert exit_targets("""
+def f(world):
+    try:
+        return a
+    except ValueError:
+        pass
+""") == ["a", None]
+    assert exit_targets("""
+def f(world):
+    with world.lock:
+        return a
+""") == ["a"]
@@ -0,0 +1,30 @@
+import time
+from dataclasses import dataclass
+
+from world_no_mpl import World
+
+
+@dataclass
+class FlakyWorld(World):
+    # update raises on its fail_on_update-th call only, like one VISA timeout
+    fail_on_update: int = 1
+    n_updates: int = 0
+
+    def update(self, state):
+        self.n_updates += 1
+        if self.n_updates == self.fail_on_update:
+            raise TimeoutError("VISA timeout")
+
+
+def test_background_acquisition_survives_a_failed_tick():
+    world = FlakyWorld(target_tick_rate_s=0.02, acquire_in_background=True, fail_on_update=2)
+    world.start_background_acquisition()
+    try:
+        deadline = time.time()+5
+        while world.n_updates < 5 and time.time() < deadline:
+            time.sleep(0.01)
+        assert world._acquisition.running
+    finally:
+        world.stop_background_acquisition()
+    assert world.n_updates >= 5
+    assert world._acquisition.n_failed == 1
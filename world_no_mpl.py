@@ -8,6 +8,7 @@ from typing import Callable, Union, Any
 import random
 import numpy as np
 from nonblocking_readline import nonblocking_readline
+from scheduler import DeadlineScheduler, TickThread
 
 # how to compile function from text
 # https://stackoverflow.com/questions/32429154/how-to-compile-a-function-at-run-time
@@ -29,6 +30,17 @@ class World:
     command: Union[Any, None] = None
     target_tick_rate_s: int = 1
     state_start_time: float = field(default=0.0, init=False)
+    # event_driven keeps tick and wait deadlines in a heap and sleeps exactly until the next one
+    # otherwise the tick target is recomputed on every pass, see process_command_and_decide_execution
+    event_driven: bool = True
+    scheduler: DeadlineScheduler = field(default_factory=DeadlineScheduler, init=False)
+    tick_deadline_s: float = field(default=None, init=False)
+    # acquire_in_background runs update on its own thread every target_tick_rate_s, so a slow
+    # update doesn't delay state lines and a slow state line doesn't delay logging
+    # state lines then see the instruments through the latest values recorded by update
+    acquire_in_background: bool = False
+    current_state: Any = field(default=None, init=False)
+    _acquisition: TickThread = field(default=None, init=False, repr=False)
     to_wait_for_process_line: float = 0.0
     # def wait(self, seconds):
     #     self.waiting_for = self.time.time() + seconds
@@ -41,16 +53,53 @@ class World:
             elapsed_s = now-self.last_update_time_s
             self.update_with_elapsed(elapsed_s=elapsed_s)
         self.last_update_time_s = now
+        if self.event_driven and not self.acquire_in_background:
+            self._schedule_next_tick(now)
+
+    def _schedule_next_tick(self, now):
+        # ticks stay on a fixed grid, if we fell behind skip the missed ones instead of bunching up
+        if self.tick_deadline_s is None:
+            self.tick_deadline_s = np.ceil(now)
+        while self.tick_deadline_s <= now:
+            self.tick_deadline_s += self.target_tick_rate_s
+        self.scheduler.schedule("tick", self.tick_deadline_s)
+
+    def start_background_acquisition(self):
+        # on its own fixed grid independent of the state lines, a failed tick is logged and the next one runs
+        if self._acquisition is not None and self._acquisition.running:
+            return
+        self._acquisition = TickThread(lambda: self._update(self.current_state), self.target_tick_rate_s,
+                                       clock=self.time, name="acquisition")
+        self._acquisition.start()
+
+    def stop_background_acquisition(self):
+        if self._acquisition is not None:
+            self._acquisition.stop()
+
+    # how to block the runner, overload if something else needs the time, like a gui event loop
+    def _sleep(self, seconds):
+        time.sleep(seconds)
 
     # meant to read updates from instruments in an async way
     # overload
     def update(self, state):
         pass
 
+    # called with the (parameter, value) reads of an AcquisitionEngine when the caller did the reads
+    # itself, e.g. AsyncWorldRunner awaiting acquire_async, instead of update
+    # overload
+    def record(self, state, results):
+        pass
+
     # overload
     def update_with_elapsed(self, elapsed_s):
         pass
 
+    # called when a state returns, with the state it returned (None when the runner is done)
+    # overload
+    def on_state_change(self, old_state, new_state):
+        pass
+
     def state_elapsed_s(self):
         return self.time.time()-self.state_start_time
 
@@ -58,36 +107,92 @@ class World:
         self.command = None
         state_gen = state.func_to_make_generator(self)
         self.state_start_time = self.time.time()
+        self.current_state = state
         line_number = 0
         self._update(state)
-        while True:
-            should_update, should_run_line = self.process_command_and_decide_execution()
-            if should_update:
-                self._update(state)
-            try: 
-                if should_run_line:
-                    line_number = state_gen.send(None)
-                yield state, line_number
-            except StopIteration as e:
-                next_state = e.value
-                if next_state is None:
-                    return
-                elif next_state != state:
-                    self.state_start_time = self.time.time()
-                state = next_state
-                state_gen = state.func_to_make_generator(self)
-                line_number = 0
-            # except KeyboardInterrupt:
-            #     print("KeyboardInterrupt: exiting")
-            #     return
+        if self.acquire_in_background:
+            self.start_background_acquisition()
+            # no ticks in this loop anymore, but still yield now and then so callers can see progress
+            self.scheduler.schedule("heartbeat", self.time.time()+self.target_tick_rate_s)
+        try:
+            while True:
+                should_update, should_run_line = self.process_command_and_decide_execution()
+                if should_update:
+                    self._update(state)
+                try: 
+                    if should_run_line:
+                        line_number = state_gen.send(None)
+                    yield state, line_number
+                except StopIteration as e:
+                    next_state = e.value
+                    self.on_state_change(state, next_state)
+                    if next_state is None:
+                        return
+                    elif next_state != state:
+                        self.state_start_time = self.time.time()
+                    state = next_state
+                    self.current_state = state
+                    state_gen = state.func_to_make_generator(self)
+                    line_number = 0
+                # except KeyboardInterrupt:
+                #     print("KeyboardInterrupt: exiting")
+                #     return
+        finally:
+            if self.acquire_in_background:
+                self.stop_background_acquisition()
             
     def next_tick_target_time_s(self):
+        if self.event_driven and self.tick_deadline_s is not None:
+            return self.tick_deadline_s
         if self.last_update_time_s is None:
             return np.ceil(self.time.time())
         return np.floor(self.last_update_time_s+self.target_tick_rate_s)
     
 
+    def process_command_and_decide_execution_event_driven(self):
+        while True:
+            now = self.time.time()
+            due = self.scheduler.pop_next_due(now)
+            if due == "heartbeat":
+                self.scheduler.schedule("heartbeat", now+self.target_tick_rate_s)
+                should_update = False
+                should_process_line = False
+                return should_update, should_process_line
+            if due == "tick":
+                should_update = True
+                should_process_line = False
+                return should_update, should_process_line
+            if self.command is None:
+                should_update = False
+                should_process_line = True
+                return should_update, should_process_line
+            elif isinstance(self.command, WaitUntil):
+                self.to_wait_for_process_line = self.command.time_s-now
+                if due == "wait":
+                    self.command = None
+                    should_update = False
+                    should_process_line = True
+                    return should_update, should_process_line
+            elif isinstance(self.command, WaitForInput) and not self.scheduler.stdin_closed:
+                line = nonblocking_readline()
+                if line == "":
+                    print("stdin closed, no more input will arrive")
+                    self.scheduler.stdin_closed = True
+                elif line is not None:
+                    line = line.strip()
+                    print(f"got line! {self.command.target_input=}")
+                    print(line)
+                    if line == self.command.target_input:
+                        self.command = None
+                        should_update = False
+                        should_process_line = True
+                        return should_update, should_process_line
+            self.scheduler.sleep_until_next(now, self._sleep, watch_stdin=isinstance(self.command, WaitForInput))
+
     def process_command_and_decide_execution(self):
+        # background acquisition needs the deadline heap, the polling path below interleaves ticks
+        if self.event_driven or self.acquire_in_background:
+            return self.process_command_and_decide_execution_event_driven()
         # either command is None or has a command
         # if it is a wait command, we may not execute a line
         # if to_wait is negative, we'll update
@@ -123,7 +228,7 @@ class World:
                     return should_update, should_process_line
 
 
-        time.sleep(to_wait_for_tick_s)
+        self._sleep(to_wait_for_tick_s)
         should_update = True
         should_process_line = False
         return should_update, should_process_line        
@@ -134,9 +239,11 @@ class World:
 
     def wait(self, seconds):
         self.command=WaitUntil(time_s = time.time()+seconds)
+        self.scheduler.schedule("wait", self.command.time_s)
 
     def wait_for_input(self, target_input):
         self.command=WaitForInput(target_input)
+        self.scheduler.cancel("wait")
             
 
     def run_state(self, state: State):